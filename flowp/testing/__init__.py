@@ -1,17 +1,51 @@
 import os.path
 import re
+import io
+import ast
+import queue
 import importlib
+import importlib.util
 import sys
 import inspect
 import traceback
+import linecache
 import time
 import tempfile
+import shutil
+import threading
 import argparse
+import contextlib
+import hashlib
+import fnmatch
+import json
 import subprocess
+import collections
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.util
+import signal
+import faulthandler
+import cProfile
+import pstats
+import tracemalloc
+import asyncio
+import contextvars
+import reprlib
+import itertools
+import collections.abc
+import types
+import builtins
+import gc
+import statistics
+from concurrent import futures
 from unittest import mock
-from glob2 import glob
-from junit_xml import TestSuite, TestCase
-from flowp import files
+from xml.sax import saxutils
+from xml.etree import ElementTree
+from flowp import files, ftypes
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # for traceback passing in test results
 TESTING_FRAME = True
@@ -20,6 +54,7 @@ TESTING_FRAME = True
 class ColorStream(str):
     GREEN = '\033[92m'
     RED = '\033[91m'
+    YELLOW = '\033[93m'
     COLOR_END = '\033[0m'
 
     def __init__(self, stream):
@@ -48,6 +83,12 @@ class ColorStream(str):
     def flush(self):
         self._stream.flush()
 
+    def isatty(self):
+        try:
+            return self._stream.isatty()
+        except (AttributeError, ValueError):
+            return False
+
 
 def only(obj):
     obj._only_mode = True
@@ -64,10 +105,181 @@ def slow(obj):
     return obj
 
 
+def timeout(seconds):
+    """Fail test if it runs longer than given number of seconds. Can be
+    used on behavior class or test method.
+    """
+    def decorator(obj):
+        obj._timeout = seconds
+        return obj
+    return decorator
+
+
+def concurrent(obj):
+    """Run async tests concurrently with other concurrent tests of the
+    same behavior class. Can be used on behavior class or test method.
+    """
+    obj._concurrent = True
+    return obj
+
+
+# attributes set by marker decorators, by their names
+_marker_attributes = {'only': '_only_mode', 'skip': '_skipped', 'slow': '_slow',
+                      'timeout': '_timeout', 'concurrent': '_concurrent'}
+
+
+class TestTimeout(BaseException):
+    """Raised in a test which exceeded its time limit. It does not derive
+    from Exception, so it is not swallowed by the tested code.
+    """
+
+
+class Watchdog:
+    """Interrupts tests which exceeded their time limit by raising
+    TestTimeout from SIGALRM handler. If test does not respond to it (e.g.
+    it is blocked in C code) stacks of all threads are dumped to the file
+    after grace period, and if exit is True the process exits, so worker
+    process can be recycled. Id of the watched test is written to the file
+    before dump then.
+    """
+    #: seconds given to the test to respond to TestTimeout
+    grace = 5.0
+
+    def __init__(self, file=None, exit=False):
+        self.file = file
+        self.exit = exit
+        self._active = False
+        self._watching = False
+        self._previous = None
+
+    def start(self, behavior, seconds):
+        """Start watching test which should end in given number of seconds"""
+        if not hasattr(signal, 'setitimer') or \
+                threading.current_thread() is not threading.main_thread():
+            return None
+
+        def interrupt(signum, frame):
+            if self._active:
+                self._active = False
+                raise TestTimeout('Test exceeded time limit of %s seconds' % seconds)
+
+        file = self.file or sys.__stderr__
+        if self.exit:
+            file.seek(0)
+            file.truncate()
+            file.write(behavior.get_info().id + '\n')
+            file.flush()
+        self._previous = signal.signal(signal.SIGALRM, interrupt)
+        self._active = self._watching = True
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+        faulthandler.dump_traceback_later(seconds + self.grace, exit=self.exit, file=file)
+
+    def stop(self):
+        if not self._watching:
+            return None
+        self._active = self._watching = False
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        faulthandler.cancel_dump_traceback_later()
+        signal.signal(signal.SIGALRM, self._previous or signal.SIG_DFL)
+
+
+class TemporaryDirectoryPool:
+    """Pool of empty temporary directories. Released directories are
+    cleared in a background thread and reused, instead of being created
+    and removed for each test. Directory is given back to the pool only
+    if it was completely cleared.
+
+    :param root:
+        directory in which temporary directories are created, it can
+        be placed on tmpfs (like /dev/shm) to make files operations
+        faster, system default is used if not given
+    """
+    def __init__(self, root=None):
+        self.root = root
+        self._pid = None
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._created = set()
+        self._clean = queue.Queue()
+        self._dirty = queue.Queue()
+        self._thread = threading.Thread(target=self._clear_loop, daemon=True)
+        self._thread.start()
+        # unlike atexit handlers, also called in worker processes
+        # of multiprocessing, which exit with os._exit
+        multiprocessing.util.Finalize(self, self.close, exitpriority=0)
+
+    def acquire(self):
+        """Return path of empty temporary directory"""
+        # pool is not shared with forked processes
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            return self._clean.get_nowait()
+        except queue.Empty:
+            path = tempfile.mkdtemp(prefix='flowp', dir=self.root)
+            self._created.add(path)
+            return path
+
+    def release(self, path):
+        """Give directory back to the pool, it will be cleared in background"""
+        self._dirty.put(path)
+
+    def wait(self):
+        """Wait until all released directories are cleared"""
+        if self._pid == os.getpid():
+            self._dirty.join()
+
+    def close(self):
+        """Remove all directories created by the pool"""
+        if self._pid != os.getpid():
+            return None
+        self._dirty.put(None)
+        self._thread.join()
+        for path in self._created:
+            shutil.rmtree(path, ignore_errors=True)
+        self._created.clear()
+        self._pid = None
+
+    def _clear_loop(self):
+        while True:
+            path = self._dirty.get()
+            try:
+                if path is None:
+                    break
+                if self._clear(path):
+                    self._clean.put(path)
+                else:
+                    shutil.rmtree(path, ignore_errors=True)
+                    self._created.discard(path)
+            finally:
+                self._dirty.task_done()
+
+    def _clear(self, path):
+        """Remove directory content, return False if it was not possible"""
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.remove(entry.path)
+            return not os.listdir(path) and \
+                os.access(path, os.R_OK | os.W_OK | os.X_OK)
+        except OSError:
+            return False
+
+
 class TemporaryDirectory:
-    """tempfile.TemporaryDirectory proxy"""
+    """tempfile.TemporaryDirectory proxy. Directories are
+    taken from the pool of cleared directories.
+    """
+    __slots__ = ('_name', '_org_cwd')
+    #: pool shared by all instances
+    pool = TemporaryDirectoryPool()
+
     def __init__(self):
-        self._tmpdir = None
+        self._name = None
         self._org_cwd = None
 
     def enter(self):
@@ -75,32 +287,186 @@ class TemporaryDirectory:
         directory to it, remembering the original one.
         """
         self._org_cwd = os.getcwd()
-        self._tmpdir = tempfile.TemporaryDirectory()
-        os.chdir(self._tmpdir.name)
+        self._name = self.pool.acquire()
+        os.chdir(self._name)
 
     def exit(self):
         """Set current working directory to the original one and
         cleanup temporary directory.
         """
-        if not self._tmpdir:
+        if not self._org_cwd:
             return None
         os.chdir(self._org_cwd)
-        self._tmpdir.cleanup()
+        self._org_cwd = None
+        self.pool.release(self._name)
 
     @property
     def name(self):
-        return self._tmpdir.name
+        return self._name
+
+
+# (stdout, stderr) buffers of the current concurrent test
+_task_output = contextvars.ContextVar('task_output', default=None)
+
+
+class TaskOutput:
+    """Stream writing to the output buffer of the current asyncio task
+    (concurrent test), or to the given stream outside of tasks.
+    """
+    def __init__(self, stream, index):
+        self.stream = stream
+        self.index = index
+
+    def write(self, text):
+        buffers = _task_output.get()
+        return (buffers[self.index] if buffers else self.stream).write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class TestInfo:
+    """Picklable identity of a test. Results keep it instead of
+    Behavior instances, so they can be passed between processes.
+    """
+    __slots__ = ('module', 'behaviors', 'method_name')
+
+    def __init__(self, module, behaviors, method_name):
+        self.module = module
+        self.behaviors = behaviors
+        self.method_name = method_name
+
+    @property
+    def id(self):
+        return '%s:%s.%s' % (self.module, '.'.join(self.behaviors),
+                             self.method_name)
+
+    @property
+    def description(self):
+        description = ''.join(self.behaviors)
+        # Transform camel case to spaces
+        return re.sub('([a-z0-9])([A-Z])', r'\1 \2', description).lower().capitalize()
+
+    @property
+    def full_description(self):
+        method_name = re.sub('^it_', '', self.method_name)
+        return self.description + ' ' + method_name.replace('_', ' ')
+
+    def get_info(self):
+        return self
+
+    @classmethod
+    def from_id(cls, test_id):
+        module, path = test_id.split(':')
+        names = path.split('.')
+        return cls(module, tuple(names[:-1]), names[-1])
+
+
+class FailureInfo:
+    """Failure of a test captured without formatting. Stack is extracted
+    without source lines and frames are not referenced, exception is kept
+    without its traceback. Traceback and exception message are formatted
+    when failure is printed or pickled.
+    """
+    __slots__ = ('_stack', '_exception', '_chain', '_text')
+
+    def __init__(self, exc_info, limit=None):
+        exctype, value, tb = exc_info
+        self._stack = traceback.StackSummary.extract(
+            traceback.walk_tb(tb), limit=limit, lookup_lines=False)
+        self._exception = value.with_traceback(None)
+        # chained exceptions are formatted right away, releasing their frames
+        self._chain = []
+        if value.__cause__ is not None:
+            chained, message = value.__cause__, (
+                '\nThe above exception was the direct cause of the following exception:\n\n')
+        elif value.__context__ is not None and not value.__suppress_context__:
+            chained, message = value.__context__, (
+                '\nDuring handling of the above exception, another exception occurred:\n\n')
+        else:
+            chained = None
+        if chained is not None:
+            self._chain.extend(traceback.TracebackException.from_exception(
+                chained, limit=limit, lookup_lines=False, compact=True).format())
+            self._chain.append(message)
+            traceback.clear_frames(chained.__traceback__)
+        self._text = None
+
+    def __str__(self):
+        if self._text is None:
+            lines = self._chain
+            if self._stack:
+                lines.append('Traceback (most recent call last):\n')
+                lines.extend(self._stack.format())
+            lines.extend(traceback.format_exception_only(type(self._exception),
+                                                         self._exception))
+            if lines[0].startswith('Traceback'):
+                lines = lines[1:]
+            lines[-1] = '  ' + lines[-1]
+            self._text = ''.join(lines)
+            self._stack = self._exception = self._chain = None
+        return self._text
+
+    def __getstate__(self):
+        return str(self)
+
+    def __setstate__(self, text):
+        self._stack = self._exception = self._chain = None
+        self._text = text
+
+
+class CollectedTest(TestInfo):
+    """Test found by parsing spec file, without importing it"""
+    __slots__ = ('markers',)
+
+    def __init__(self, module, behaviors, method_name, markers):
+        super().__init__(module, behaviors, method_name)
+        self.markers = markers
+
+
+class PlannedTest(TestInfo):
+    """Immutable record of test loaded from behavior class: its class,
+    parent behavior classes (outer first) and method name. Behavior
+    instance is created only to run the test.
+    """
+    __slots__ = ('behavior_class', 'parent_behaviors')
+
+    def __init__(self, behavior_class, parent_behaviors, method_name, behaviors=None):
+        if behaviors is None:
+            behaviors = tuple(behavior.__name__ for behavior in parent_behaviors) + \
+                (behavior_class.__name__,)
+        for name, value in (('module', behavior_class.__module__), ('behaviors', behaviors),
+                            ('method_name', method_name), ('behavior_class', behavior_class),
+                            ('parent_behaviors', parent_behaviors)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % self.__class__.__name__)
+
+    def get_info(self):
+        return TestInfo(self.module, self.behaviors, self.method_name)
+
+    def create(self, results):
+        """Create behavior instance running the test"""
+        return self.behavior_class(self.method_name, results, self.parent_behaviors)
 
 
 class Behavior:
     """Test case"""
     parent_behaviors = tuple()
 
-    def __init__(self, method_name, results):
+    def __init__(self, method_name, results, parent_behaviors=()):
         self.method_name = method_name
+        if parent_behaviors:
+            self.parent_behaviors = parent_behaviors
         self._results = results
         self.tmpdir = TemporaryDirectory()
 
+    def get_info(self):
+        behaviors = tuple(pbehavior.__name__ for pbehavior in self.parent_behaviors)
+        behaviors += (self.__class__.__name__,)
+        return TestInfo(self.__class__.__module__, behaviors, self.method_name)
+
     def _have_only_mode(self):
         if hasattr(self, '_only_mode'):
             return True
@@ -125,6 +491,40 @@ class Behavior:
                 return True
         return False
 
+    def is_slow(self):
+        """Check if test method or one of behaviors is marked as slow"""
+        return hasattr(getattr(self, self.method_name), '_slow') or self._is_slow()
+
+    def is_concurrent(self):
+        """Check if test is async and it or one of behaviors is marked as
+        concurrent
+        """
+        method = getattr(self, self.method_name)
+        if not inspect.iscoroutinefunction(method):
+            return False
+        return hasattr(method, '_concurrent') or hasattr(self, '_concurrent') or \
+            any(hasattr(pbehavior, '_concurrent') for pbehavior in self.parent_behaviors)
+
+    def get_timeout(self, default=None):
+        """Return time limit of test in seconds, set by @timeout on test
+        method or the nearest behavior, or default one.
+        """
+        method = getattr(self, self.method_name)
+        if hasattr(method, '_timeout'):
+            return method._timeout
+        if hasattr(self, '_timeout'):
+            return self._timeout
+        for pbehavior in reversed(self.parent_behaviors):
+            if hasattr(pbehavior, '_timeout'):
+                return pbehavior._timeout
+        return default
+
+    def before_all(self):
+        pass
+
+    def after_all(self):
+        pass
+
     def before_each(self):
         pass
 
@@ -133,55 +533,174 @@ class Behavior:
 
     def _call_before_each_methods(self):
         for parent_behavior in self.parent_behaviors:
-            parent_behavior.before_each(self)
-        self.before_each()
+            self._await(parent_behavior.before_each(self))
+        self._await(self.before_each())
 
     def _call_after_each_methods(self):
-        self.after_each()
+        self._await(self.after_each())
         for parent_behavior in reversed(self.parent_behaviors):
-            parent_behavior.after_each(self)
+            self._await(parent_behavior.after_each(self))
+
+    def _await(self, result):
+        """Run result of test or hook to completion on the event loop of
+        results, if it is awaitable
+        """
+        if inspect.isawaitable(result):
+            return self._results.get_loop().run_until_complete(result)
+        return result
 
-    def run(self, only_mode=False, fast_mode=False):
-        """Run specific test"""
+    def get_skip_reason(self, only_mode=False, fast_mode=False):
+        """Return 'skipped' or 'slow' if test should be skipped, None otherwise"""
         method = getattr(self, self.method_name)
-        self._results.start_test()
         if only_mode and (not hasattr(method, '_only_mode') and
                           not self._have_only_mode()):
-            self._results.add_skipped(self)
-            return None
+            return 'skipped'
         if self._is_skipped() or hasattr(method, '_skipped'):
-            self._results.add_skipped(self)
-            return None
-        if fast_mode and (hasattr(method, '_slow') or
-                          self._is_slow()):
+            return 'skipped'
+        if fast_mode and self.is_slow():
+            return 'slow'
+        return None
+
+    def run(self, only_mode=False, fast_mode=False, timeout=None, watchdog=None):
+        """Run specific test. Test running longer than timeout seconds
+        (or time limit set by @timeout) fails.
+        """
+        method = getattr(self, self.method_name)
+        self._results.start_test()
+        skip_reason = self.get_skip_reason(only_mode, fast_mode)
+        if skip_reason == 'slow':
             self._results.add_skipped_slow(self)
+            self._results.stop_test(self)
+            return None
+        elif skip_reason:
+            self._results.add_skipped(self)
+            self._results.stop_test(self)
             return None
 
-        try:
-            self._results.add_executed()
-            self._call_before_each_methods()
-            method()
-
-        # Catching exceptions
-        except:
+        self._results.add_executed()
+        if inspect.iscoroutinefunction(method):
+            coroutine_function = method
+
+            def method():
+                return self._await(coroutine_function())
+
+        with contextlib.ExitStack() as capture:
+            if self._results.capture_output:
+                stdout = capture.enter_context(contextlib.redirect_stdout(io.StringIO()))
+                stderr = capture.enter_context(contextlib.redirect_stderr(io.StringIO()))
+            timeout = self.get_timeout(timeout)
+            if timeout:
+                watchdog = watchdog or Watchdog()
+                watchdog.start(self, timeout)
+            memory_checker = self._results.memory_checker
+            if memory_checker:
+                # shared event loop, created by the first async test, is not its leak
+                self._results.get_loop()
+                memory_checker.start(self)
+            profiler = self._results.profiler
+            benchmark = self._results.benchmark
+            line_coverage = self._results.line_coverage
+            start_time, start_cpu_time = time.perf_counter(), time.process_time()
+            if profiler:
+                profiler.enable(self)
+            exc_info = None
             try:
-                self._call_after_each_methods()
-                mock.patch.stopall()
+                if line_coverage:
+                    line_coverage.start(self)
+                self._call_before_each_methods()
+                if benchmark:
+                    stats = benchmark.run(method)
+                    self._results.add_benchmark(self, stats)
+                    benchmark.check(self.get_info().id, stats)
+                else:
+                    method()
+            # Catching exceptions
             except:
-                self._results.add_failure(sys.exc_info(), self)
-            else:
-                self._results.add_failure(sys.exc_info(), self)
-        else:
+                exc_info = sys.exc_info()
+
             try:
                 self._call_after_each_methods()
                 mock.patch.stopall()
             except:
-                self._results.add_failure(sys.exc_info(), self)
+                exc_info = sys.exc_info()
+            if profiler:
+                profiler.disable()
+            if line_coverage:
+                line_coverage.stop(self)
+            if timeout:
+                watchdog.stop()
+
+            self._results.add_duration(self, time.perf_counter() - start_time,
+                                       time.process_time() - start_cpu_time)
+        if self._results.capture_output:
+            self._results.add_output(self, stdout.getvalue(), stderr.getvalue())
+            stdout = stderr = None
+        try:
+            if exc_info:
+                self._results.add_failure(exc_info, self)
+            else:
+                self._results.add_success(self)
+        finally:
+            # break reference cycle through the traceback, so frames
+            # of the test are released right away
+            exc_info = None
+            if memory_checker:
+                memory_checker.stop(self)
+            self._results.stop_test(self)
+
+    async def run_async(self, timeout=None):
+        """Run specific async test, which is not skipped, as a task of the
+        running event loop, concurrently with other tests. Its output is
+        captured by TaskOutput streams and test running longer than timeout
+        seconds (or time limit set by @timeout) is cancelled.
+        """
+        method = getattr(self, self.method_name)
+        self._results.start_test()
+        self._results.add_executed()
+        stdout, stderr = io.StringIO(), io.StringIO()
+        _task_output.set((stdout, stderr))
+        timeout = self.get_timeout(timeout)
+        start_time, start_cpu_time = time.perf_counter(), time.process_time()
+        exc_info = None
+        try:
+            for parent_behavior in self.parent_behaviors:
+                await self._awaitable(parent_behavior.before_each(self))
+            await self._awaitable(self.before_each())
+            if timeout:
+                try:
+                    await asyncio.wait_for(method(), timeout)
+                except asyncio.TimeoutError:
+                    raise TestTimeout('Test exceeded time limit of %s seconds'
+                                      % timeout) from None
+            else:
+                await method()
+        except:
+            exc_info = sys.exc_info()
+
+        try:
+            await self._awaitable(self.after_each())
+            for parent_behavior in reversed(self.parent_behaviors):
+                await self._awaitable(parent_behavior.after_each(self))
+        except:
+            exc_info = sys.exc_info()
+        # cpu time is shared by tests running at the same time
+        self._results.add_duration(self, time.perf_counter() - start_time,
+                                   time.process_time() - start_cpu_time)
+        if self._results.capture_output:
+            self._results.add_output(self, stdout.getvalue(), stderr.getvalue())
+        try:
+            if exc_info:
+                self._results.add_failure(exc_info, self)
             else:
                 self._results.add_success(self)
         finally:
-            if self._results.executed < self._results.all:
-                self._results.print_execution_info(in_place=True)
+            exc_info = None
+            self._results.stop_test(self)
+
+    async def _awaitable(self, result):
+        if inspect.isawaitable(result):
+            return await result
+        return result
 
     def mock(self, target=None, attr=None, new=mock.DEFAULT, spec=None):
         """Create a mock and register it in behavior mocks manager.
@@ -215,19 +734,76 @@ class Behavior:
 
 class Results:
     """Gather informations about test results"""
-    def __init__(self):
-        self.stream = ColorStream(sys.stdout)
+    #: whether stdout and stderr of tests should be captured
+    capture_output = False
+    #: whether execution info should be printed during the run
+    show_progress = True
+    #: Profiler of tests, if profiling
+    profiler = None
+    #: MemoryChecker of tests, if checking memory
+    memory_checker = None
+    #: Benchmark running bench_ methods, in benchmark mode
+    benchmark = None
+    #: LineCoverage recording lines executed by tests, if collecting coverage
+    line_coverage = None
+    #: connection to which summary of each test is sent (by forked workers)
+    sink = None
+    #: event loop running async tests and hooks
+    loop = None
+    #: how many times per second progress is redrawn on terminal
+    progress_rate = 10
+    #: how often (in seconds) progress line is printed if output is not a terminal
+    progress_interval = 10.0
+    def __init__(self, stream=None):
+        self.stream = ColorStream(stream or sys.stdout)
         self.failures = []
         self.skipped = 0
         self.executed = 0
         self.all = 0
         self.skipped_slow = 0
+        # tests of behaviors which passed and did not change, in incremental mode
+        self.cached = 0
+        # failures of tests which passed when run again
+        self.flaky = []
+        # failures of quarantined tests, which do not fail the run
+        self.quarantined = []
+        # test id: (wall time, cpu time)
+        self.durations = {}
+        # ids of executed tests marked as slow
+        self.marked_slow = set()
+        # stats of benchmarks by their ids
+        self.benchmarks = {}
+        self._progress_time = time.monotonic()
+
+    def get_loop(self):
+        """Return event loop shared by async tests of the run, create it
+        when first needed
+        """
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        return self.loop
+
+    def close_loop(self):
+        if self.loop is not None:
+            self.loop.close()
+            self.loop = None
 
     def start_test(self):
         pass
 
-    def stop_test(self):
-        pass
+    def stop_test(self, behavior):
+        if self.sink:
+            self.sink.send(('test', behavior.get_info().id, self.get_summary(extras=False)))
+            self.reset()
+        self.print_progress()
+
+    def reset(self):
+        """Forget gathered results, after their summary was sent"""
+        self.executed = self.skipped = self.skipped_slow = 0
+        self.failures = []
+        self.durations = {}
+        self.marked_slow = set()
+        self.benchmarks = {}
 
     def add_success(self, behavior):
         pass
@@ -238,65 +814,144 @@ class Results:
     def add_skipped_slow(self, behavior):
         self.skipped_slow += 1
 
+    def add_cached(self, test):
+        self.cached += 1
+
     def add_executed(self):
         self.executed += 1
 
-    def add_failure(self, exc_info, behavior):
-        self.failures.append((self._exc_info_to_string(exc_info), behavior))
+    def add_output(self, behavior, stdout, stderr):
+        pass
 
-    def get_behaviors_description(self, behavior: Behavior):
-        description = ''
+    def add_benchmark(self, behavior, stats):
+        self.benchmarks[behavior.get_info().id] = stats
 
-        for parent_behavior in behavior.parent_behaviors:
-            description += parent_behavior.__name__
+    def add_duration(self, behavior, wall_time, cpu_time):
+        test_id = behavior.get_info().id
+        self.durations[test_id] = (wall_time, cpu_time)
+        if behavior.is_slow():
+            self.marked_slow.add(test_id)
 
-        description += behavior.__class__.__name__
-        # Transform camel case to spaces
-        description = re.sub('([a-z0-9])([A-Z])', r'\1 \2', description).lower().capitalize()
-        return description
+    def add_failure(self, exc_info, behavior):
+        self.failures.append((self._exc_info_to_failure(exc_info), behavior.get_info()))
 
-    def print_execution_info(self, in_place=False):
+    def get_summary(self, extras=True):
+        """Return picklable summary of results, which can be
+        merged into results of another process. Profile and memory
+        checks are included only with extras.
+        """
+        return {
+            'executed': self.executed,
+            'skipped': self.skipped,
+            'skipped_slow': self.skipped_slow,
+            'failures': self.failures,
+            'durations': self.durations,
+            'marked_slow': self.marked_slow,
+            'profile': self.profiler.get_summary() if self.profiler and extras else None,
+            'memcheck': (self.memory_checker.get_summary()
+                         if self.memory_checker and extras else None),
+            'benchmarks': self.benchmarks,
+            'coverage': (self.line_coverage.get_summary()
+                         if self.line_coverage and extras else None),
+        }
+
+    def merge(self, summary):
+        """Merge summary returned by get_summary"""
+        self.executed += summary['executed']
+        self.skipped += summary['skipped']
+        self.skipped_slow += summary['skipped_slow']
+        self.failures.extend(summary['failures'])
+        self.durations.update(summary['durations'])
+        self.marked_slow.update(summary['marked_slow'])
+        self.benchmarks.update(summary['benchmarks'])
+        if self.profiler and summary['profile']:
+            self.profiler.merge(summary['profile'])
+        if self.memory_checker and summary['memcheck']:
+            self.memory_checker.merge(summary['memcheck'])
+        if self.line_coverage and summary['coverage']:
+            self.line_coverage.merge(summary['coverage'])
+
+    def get_behaviors_description(self, behavior: Behavior):
+        return behavior.get_info().description
+
+    def get_execution_info(self):
         failures = len(self.failures)
-        if in_place:
-            self.stream.write('\r')
-        self.stream.write('Executed %s of %s ' % (self.executed, self.all))
+        info = 'Executed %s of %s ' % (self.executed, self.all)
         if self.skipped:
-            self.stream.write('(%s skipped) ' % self.skipped)
+            info += '(%s skipped) ' % self.skipped
         if self.skipped_slow:
-            self.stream.write('(%s too slow) ' % self.skipped_slow)
+            info += '(%s too slow) ' % self.skipped_slow
+        if self.cached:
+            info += '(%s cached) ' % self.cached
+        if self.flaky:
+            info += '(%s flaky) ' % len(self.flaky)
+        if self.quarantined:
+            info += '(%s quarantined) ' % len(self.quarantined)
         if failures:
-            self.stream.red('(%s FAILED) ' % failures)
+            info += ColorStream.RED + '(%s FAILED) ' % failures + ColorStream.COLOR_END
+        else:
+            info += ColorStream.GREEN + 'SUCCESS ' + ColorStream.COLOR_END
+        return info
+
+    def print_execution_info(self, in_place=False):
+        self.stream.write(('\r' if in_place else '') + self.get_execution_info())
+
+    def print_progress(self):
+        """Print execution info during the run. On terminal it is redrawn
+        at most progress_rate times per second, otherwise it is printed as
+        a separate line every progress_interval seconds.
+        """
+        if not self.show_progress or self.executed >= self.all:
+            return None
+        now = time.monotonic()
+        if self.stream.isatty():
+            if now - self._progress_time < 1 / self.progress_rate:
+                return None
+            self.print_execution_info(in_place=True)
         else:
-            self.stream.green('SUCCESS ')
+            if now - self._progress_time < self.progress_interval:
+                return None
+            self.stream.writeln(self.get_execution_info())
+        self.stream.flush()
+        self._progress_time = now
 
     def print(self, time_taken):
-        # clean line
-        self.stream.write('\r')
-        if self.failures:
-            self.stream.write(' ' * 80)
+        output = []
+        if self.stream.isatty():
+            # clean line
+            output.append('\r')
+            if self.failures:
+                output.append(' ' * 80)
 
         # failures
-        for err, behavior in self.failures:
-            method_name = behavior.method_name[3:].replace('_', ' ')
-            description = self.get_behaviors_description(behavior) + ' ' + method_name
-            self.stream.red("\n%s FAILED\n" % description)
-            self.stream.write("%s\n" % err)
+        for err, info in self.failures:
+            output.append(ColorStream.RED + "\n%s FAILED\n" % info.full_description +
+                          ColorStream.COLOR_END)
+            output.append("%s\n" % err)
+        for label, failures in (('FLAKY, passed when run again', self.flaky),
+                                ('FAILED, quarantined', self.quarantined)):
+            for err, info in failures:
+                output.append(ColorStream.YELLOW + "\n%s %s\n" % (info.full_description, label) +
+                              ColorStream.COLOR_END)
+                output.append("%s\n" % err)
 
         # sum up
-        self.print_execution_info()
-        self.stream.writeln('(%.3f sec)' % time_taken)
+        output.append(self.get_execution_info())
+        output.append('(%.3f sec)\n' % time_taken)
+        self.stream.write(''.join(output))
 
-    def _exc_info_to_string(self, err):
-        """Converts a sys.exc_info()-style tuple of values into a string."""
+    def _exc_info_to_failure(self, err):
+        """Capture a sys.exc_info()-style tuple of values as FailureInfo
+        and release locals of its frames.
+        """
         exctype, value, tb = err
         # Skip test runner traceback levels
         while tb and self._is_relevant_tb_level(tb):
             tb = tb.tb_next
         length = self._count_relevant_tb_levels(tb)
-        msg_lines = traceback.format_exception(exctype, value, tb, length)[1:]
-        msg_lines[-1] = '  ' + msg_lines[-1]
-        msg_lines = ''.join(msg_lines)
-        return msg_lines
+        failure = FailureInfo((exctype, value, tb), length)
+        traceback.clear_frames(err[2])
+        return failure
 
     def _count_relevant_tb_levels(self, tb):
         length = 0
@@ -318,50 +973,735 @@ class Results:
 
 
 class JunitResults(Results):
-    """Gather informations about test results"""
-    def __init__(self):
-        super().__init__()
+    """Gather informations about test results and write them
+    to JUnit XML file, as soon as test ends.
+
+    :param path:
+        path of the XML file, if None given test cases are only
+        kept in junit_cases list (used by worker processes)
+    """
+    capture_output = True
+    # space reserved in testsuite tag for attributes known at the end
+    HEADER_SPACE = 120
+    INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+    def __init__(self, stream=None, path='output.xml'):
+        super().__init__(stream)
+        self.path = path
+        self.junit_cases = []
+        self._outputs = {}
+        self._file = None
+        # number of failure elements written, also of tests which failures
+        # were put aside later (flaky and quarantined ones)
+        self._failures_written = 0
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._file = open(path, 'wb')
+            self._file.write(b'<?xml version="1.0" encoding="utf-8"?>\n<testsuites>\n'
+                             b'<testsuite name="Test Results"')
+            self._header_position = self._file.tell()
+            self._file.write(b' ' * self.HEADER_SPACE + b'>\n')
+            self._file.flush()
+
+    @staticmethod
+    def merge_files(paths, output):
+        """Merge JUnit XML files (e.g. of shards) into one file, summing
+        their totals.
+        """
+        totals = {'tests': 0, 'failures': 0, 'errors': 0, 'skipped': 0}
+        time_taken = 0.0
+        suite = ElementTree.Element('testsuite', name='Test Results')
+        for path in paths:
+            for other in ElementTree.parse(path).iter('testsuite'):
+                for name in totals:
+                    totals[name] += int(other.get(name, 0))
+                time_taken += float(other.get('time', 0))
+                suite.extend(other.findall('testcase'))
+        for name, value in totals.items():
+            suite.set(name, str(value))
+        suite.set('time', '%.3f' % time_taken)
+        root = ElementTree.Element('testsuites')
+        root.append(suite)
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        ElementTree.ElementTree(root).write(output, encoding='utf-8', xml_declaration=True)
+
+    def get_summary(self, extras=True):
+        summary = super().get_summary(extras)
+        summary['junit_cases'] = self.junit_cases
+        return summary
+
+    def reset(self):
+        super().reset()
         self.junit_cases = []
 
+    def merge(self, summary):
+        super().merge(summary)
+        for case in summary['junit_cases']:
+            self._write_case(case)
+
+    def add_output(self, behavior, stdout, stderr):
+        self._outputs[behavior.get_info().id] = (stdout, stderr)
+
     def add_success(self, behavior):
         super().add_success(behavior)
-        test_case = TestCase(self.get_behaviors_description(behavior))
-        self.junit_cases.append(test_case)
+        self._add_case(behavior)
 
     def add_skipped(self, behavior):
         super().add_skipped(behavior)
-        test_case = TestCase(self.get_behaviors_description(behavior))
-        test_case.add_skipped_info(message='Skipped')
-        self.junit_cases.append(test_case)
+        self._add_case(behavior, skipped='Skipped')
 
     def add_skipped_slow(self, behavior):
         super().add_skipped_slow(behavior)
-        test_case = TestCase(self.get_behaviors_description(behavior))
-        test_case.add_skipped_info(message='Test ran too slowly and was skipped.')
-        self.junit_cases.append(test_case)
+        self._add_case(behavior, skipped='Test ran too slowly and was skipped.')
+
+    def add_cached(self, test):
+        super().add_cached(test)
+        self._add_case(test)
 
     def add_failure(self, exc_info, behavior):
         super().add_failure(exc_info, behavior)
-        test_case = TestCase(self.get_behaviors_description(behavior))
-        test_case.add_failure_info(message='Test Failed', output=self._exc_info_to_string(exc_info))
-        self.junit_cases.append(test_case)
+        self._add_case(behavior, failure=self.failures[-1][0])
+
+    def _add_case(self, behavior, failure=None, skipped=None):
+        info = behavior.get_info()
+        wall_time, cpu_time = self.durations.get(info.id, (0, 0))
+        stdout, stderr = self._outputs.pop(info.id, ('', ''))
+        case = {
+            'classname': '%s.%s' % (info.module, '.'.join(info.behaviors)),
+            'name': info.method_name,
+            'time': wall_time,
+            'failure': failure,
+            'skipped': skipped,
+            'stdout': stdout,
+            'stderr': stderr,
+        }
+        self._write_case(case)
+
+    def _write_case(self, case):
+        if not self._file:
+            self.junit_cases.append(case)
+            return None
+        lines = ['  <testcase classname=%s name=%s time="%.6f">' % (
+            self._quote(case['classname']), self._quote(case['name']), case['time'])]
+        if case['failure'] is not None:
+            self._failures_written += 1
+            lines.append('    <failure type="failure" message="Test Failed">%s</failure>' %
+                         self._escape(str(case['failure'])))
+        if case['skipped'] is not None:
+            lines.append('    <skipped type="skipped" message=%s/>' %
+                         self._quote(case['skipped']))
+        if case['stdout']:
+            lines.append('    <system-out>%s</system-out>' % self._escape(case['stdout']))
+        if case['stderr']:
+            lines.append('    <system-err>%s</system-err>' % self._escape(case['stderr']))
+        lines.append('  </testcase>\n')
+        self._file.write('\n'.join(lines).encode('utf-8'))
+        self._file.flush()
+
+    def _escape(self, text):
+        return saxutils.escape(self.INVALID_XML_CHARS.sub('', text))
+
+    def _quote(self, text):
+        return saxutils.quoteattr(self.INVALID_XML_CHARS.sub('', text))
 
     def print(self, time_taken):
         super().print(time_taken)
-        test_suite = TestSuite("Test Results", self.junit_cases)
-        with open('output.xml', 'w') as f:
-            TestSuite.to_file(f, [test_suite], prettyprint=True)
+        if not self._file:
+            return None
+        skipped = self.skipped + self.skipped_slow
+        attributes = ' tests="%s" failures="%s" errors="0" skipped="%s" time="%.3f"' % (
+            self.executed + self.cached + skipped, self._failures_written, skipped, time_taken)
+        self._file.write(b'</testsuite>\n</testsuites>\n')
+        self._file.seek(self._header_position)
+        self._file.write(attributes.encode('utf-8'))
+        self._file.close()
+        self._file = None
+
+
+class Storage:
+    """Keeps runner data between runs, as JSON files in the
+    given directory of the project root.
+    """
+    def __init__(self, path='.flowp'):
+        self.path = path
+
+    def load(self, name, default=None):
+        try:
+            with open(os.path.join(self.path, name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return default
+
+    def save(self, name, data):
+        os.makedirs(self.path, exist_ok=True)
+        fn = os.path.join(self.path, name)
+        tmp_fn = '%s.%s.tmp' % (fn, os.getpid())
+        with open(tmp_fn, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_fn, fn)
+
+
+class Profiler:
+    """Profiles tests with cProfile, aggregating stats per behavior class,
+    and measures time of runner's own phases (discovery, imports, ...).
+    Summary of stats can be merged from worker processes.
+    """
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        # cProfile.Profile objects of this process, by behavior paths
+        self.profiles = {}
+        # stats dicts merged from other processes, by behavior paths
+        self.stats = {}
+        # time of runner phases, in seconds
+        self.phases = {}
+        self._profile = None
+
+    def enable(self, behavior):
+        info = behavior.get_info()
+        path = '%s:%s' % (info.module, '.'.join(info.behaviors))
+        self._profile = self.profiles.get(path)
+        if self._profile is None:
+            self._profile = self.profiles[path] = cProfile.Profile()
+        self._profile.enable()
+
+    def disable(self):
+        self._profile.disable()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start_time
+
+    def get_summary(self):
+        """Return picklable summary of stats and phases"""
+        stats = dict(self.stats)
+        for path, profile in self.profiles.items():
+            profile.create_stats()
+            stats[path] = self._add_stats(stats.get(path, {}), profile.stats)
+        return {'stats': stats, 'phases': self.phases}
+
+    def merge(self, summary):
+        """Merge summary returned by get_summary"""
+        for path, data in summary['stats'].items():
+            self.stats[path] = self._add_stats(self.stats.get(path, {}), data)
+        for name, seconds in summary['phases'].items():
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def get_stats(self):
+        """Return pstats.Stats of all profiled tests"""
+        stats = pstats.Stats()
+        for data in self.get_summary()['stats'].values():
+            stats.add(self._make_stats(data))
+        return stats
+
+    def get_behaviors_times(self):
+        """Return list of (behavior path, profiled time) tuples, the
+        longest first.
+        """
+        times = [(path, sum(stat[2] for stat in data.values()))
+                 for path, data in self.get_summary()['stats'].items()]
+        return sorted(times, key=lambda item: item[1], reverse=True)
+
+    def _add_stats(self, data, other):
+        if not data:
+            return other
+        stats = self._make_stats(data)
+        stats.add(self._make_stats(other))
+        return stats.stats
+
+    def _make_stats(self, data):
+        stats = pstats.Stats()
+        stats.stats = data
+        stats.get_top_level_stats()
+        return stats
+
+
+class MemoryChecker:
+    """Finds tests which retain memory, comparing tracemalloc snapshots
+    taken before and after each test (with its before / after methods).
+    Attributes set on behavior instance by the test are removed before
+    the comparison. Timeline of peak RSS of the process is recorded too.
+
+    :param threshold:
+        retained memory (in bytes) above which tests are reported
+    """
+    #: number of allocation sites reported for each test
+    top_sites = 5
+    #: growth of peak RSS (in bytes) recorded in timeline
+    timeline_step = 1024 * 1024
+    #: allocations of the runner itself are not taken into account
+    filters = (
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, traceback.__file__),
+        tracemalloc.Filter(False, linecache.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+    )
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.start_time = time.time()
+        # (test id, retained bytes, allocation sites)
+        self.leaks = []
+        # (time, process id, peak RSS in bytes, test id)
+        self.timeline = []
+        self._peak_rss = 0
+        self._snapshot = None
+
+    def start(self, behavior):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._attributes = set(vars(behavior))
+        self._snapshot = tracemalloc.take_snapshot()
+        self._traced = tracemalloc.get_traced_memory()[0]
+
+    def stop(self, behavior):
+        for name in set(vars(behavior)) - self._attributes:
+            delattr(behavior, name)
+        gc.collect()
+        # comparing snapshots is expensive, so it is done only if
+        # memory traced in total grew enough
+        if tracemalloc.get_traced_memory()[0] - self._traced > self.threshold:
+            snapshot = tracemalloc.take_snapshot().filter_traces(self.filters)
+            stats = snapshot.compare_to(self._snapshot.filter_traces(self.filters), 'lineno')
+            retained = sum(stat.size_diff for stat in stats)
+            if retained > self.threshold:
+                sites = [str(stat) for stat in stats if stat.size_diff > 0]
+                self.leaks.append((behavior.get_info().id, retained, sites[:self.top_sites]))
+        self._snapshot = None
+
+        if resource:
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # kilobytes on Linux, bytes on macOS
+            if sys.platform != 'darwin':
+                peak_rss *= 1024
+            if peak_rss >= self._peak_rss + self.timeline_step:
+                self._peak_rss = peak_rss
+                self.timeline.append((time.time(), os.getpid(), peak_rss,
+                                      behavior.get_info().id))
+
+    def get_summary(self):
+        """Return picklable summary of leaks and timeline"""
+        return {'leaks': self.leaks, 'timeline': self.timeline}
+
+    def merge(self, summary):
+        """Merge summary returned by get_summary"""
+        self.leaks.extend(summary['leaks'])
+        self.timeline.extend(summary['timeline'])
+
+
+class LineCoverage:
+    """Records lines of project files executed by each test (with its
+    before / after methods), using sys.monitoring on Python 3.12+ and
+    sys.settrace otherwise. Summary can be merged from worker processes.
+    Lines of the runner itself are not recorded.
+
+    :param root:
+        directory of the project, files outside of it are not recorded
+    """
+    def __init__(self, root=None):
+        self.root = os.path.abspath(root or os.getcwd())
+        # executed lines by test ids: {path: [line, ...]}
+        self.lines = {}
+        # paths relative to root by file names of code objects, None
+        # for files which are not recorded
+        self._paths = {__file__: None}
+        self._current = None
+        self._previous = None
+        # frames running when the test started, their lines are not recorded
+        self._outer_frames = ()
+        self._monitoring = hasattr(sys, 'monitoring')
+        # sys.monitoring tool id, claimed at the first start
+        self._tool_id = None
+
+    def start(self, behavior):
+        self._current = {}
+        if self._monitoring and self._tool_id is None:
+            self._tool_id = self._claim_tool_id()
+            self._monitoring = self._tool_id is not None
+        if not self._monitoring:
+            self._previous = sys.gettrace()
+            sys.settrace(self._trace)
+            threading.settrace(self._trace)
+            return None
+        frames = set()
+        frame = sys._getframe(1)
+        while frame:
+            frames.add(frame)
+            frame = frame.f_back
+        self._outer_frames = frames
+        # lines disabled after the first hit are reported again
+        sys.monitoring.restart_events()
+
+    def _claim_tool_id(self):
+        """Claim sys.monitoring tool id for coverage, or other free one
+        (e.g. if coverage is measured by other tool). Return None if all
+        are in use.
+        """
+        monitoring = sys.monitoring
+        for tool_id in (monitoring.COVERAGE_ID, 3, 4):
+            try:
+                monitoring.use_tool_id(tool_id, 'flowp')
+            except ValueError:
+                continue
+            monitoring.register_callback(tool_id, monitoring.events.LINE, self._line_event)
+            monitoring.set_events(tool_id, monitoring.events.LINE)
+            return tool_id
+        return None
+
+    def stop(self, behavior):
+        if not self._monitoring:
+            sys.settrace(self._previous)
+            threading.settrace(None)
+        self._outer_frames = ()
+        self.lines[behavior.get_info().id] = {
+            path: sorted(lines) for path, lines in (self._current or {}).items()}
+        self._current = None
+
+    def close(self):
+        """Stop monitoring events, after all tests were run"""
+        if self._tool_id is not None:
+            monitoring = sys.monitoring
+            monitoring.set_events(self._tool_id, 0)
+            monitoring.register_callback(self._tool_id, monitoring.events.LINE, None)
+            monitoring.free_tool_id(self._tool_id)
+            self._tool_id = None
+
+    def _get_path(self, filename):
+        try:
+            return self._paths[filename]
+        except KeyError:
+            path = os.path.abspath(filename)
+            if path.startswith(self.root + os.sep) and os.path.isfile(path):
+                self._paths[filename] = os.path.relpath(path, self.root)
+            else:
+                self._paths[filename] = None
+            return self._paths[filename]
+
+    def _line_event(self, code, line):
+        path = self._get_path(code.co_filename)
+        if not path or self._current is None:
+            return sys.monitoring.DISABLE
+        if sys._getframe(1) in self._outer_frames:
+            # line can be executed by the test too, it's not disabled
+            return None
+        self._current.setdefault(path, set()).add(line)
+        return sys.monitoring.DISABLE
+
+    def _trace(self, frame, event, arg):
+        if self._get_path(frame.f_code.co_filename):
+            return self._trace_lines
+        return None
+
+    def _trace_lines(self, frame, event, arg):
+        if event == 'line' and self._current is not None:
+            self._current.setdefault(self._paths[frame.f_code.co_filename],
+                                     set()).add(frame.f_lineno)
+        return self._trace_lines
+
+    def get_summary(self):
+        """Return picklable summary of executed lines"""
+        return self.lines
+
+    def merge(self, summary):
+        """Merge summary returned by get_summary"""
+        self.lines.update(summary)
+
+    @staticmethod
+    def update_index(index, lines):
+        """Update index of tests by executed lines with lines of tests
+        run again. Index is a dict with list of tests ids and dict of
+        indexes of tests in that list, by paths and lines.
+        """
+        tests = [test_id for test_id in index.get('tests', []) if test_id not in lines]
+        new_positions = {test_id: position for position, test_id in enumerate(tests)}
+        positions = [new_positions.get(test_id) for test_id in index.get('tests', [])]
+        files = {}
+        for path, tests_by_lines in index.get('files', {}).items():
+            for line, indexes in tests_by_lines.items():
+                indexes = [positions[i] for i in indexes if positions[i] is not None]
+                if indexes:
+                    files.setdefault(path, {})[line] = indexes
+        for test_id in sorted(lines):
+            tests.append(test_id)
+            for path, path_lines in lines[test_id].items():
+                tests_by_lines = files.setdefault(path, {})
+                for line in path_lines:
+                    tests_by_lines.setdefault(str(line), []).append(len(tests) - 1)
+        return {'tests': tests, 'files': files}
+
+    @staticmethod
+    def get_tests(index, changes):
+        """Return ids of tests which executed changed lines, given as
+        sets of lines by paths
+        """
+        tests = index.get('tests', [])
+        affected = set()
+        for path, lines in changes.items():
+            tests_by_lines = index.get('files', {}).get(path, {})
+            for line in lines:
+                affected.update(tests[i] for i in tests_by_lines.get(str(line), ()))
+        return affected
+
+    @staticmethod
+    def parse_diff(text):
+        """Return changed lines of old versions of files in unified diff,
+        as sets of lines by paths. Lines around inserted ones (which do not
+        replace removed ones) are changed.
+        """
+        changes = {}
+        path = None
+        old_count = new_count = 0
+        for line in text.splitlines():
+            if old_count > 0 or new_count > 0:
+                if line.startswith('-'):
+                    changes[path].add(old_line)
+                    old_line += 1
+                    old_count -= 1
+                    replacing = True
+                elif line.startswith('+'):
+                    if not replacing:
+                        changes[path].update((old_line - 1, old_line))
+                    new_count -= 1
+                elif not line.startswith('\\'):
+                    old_line += 1
+                    old_count -= 1
+                    new_count -= 1
+                    replacing = False
+            elif line.startswith('--- '):
+                path = line[4:].split('\t')[0].strip()
+                if path == '/dev/null':
+                    path = None
+                elif path.startswith('a/'):
+                    path = path[2:]
+                if path:
+                    path = os.path.normpath(path)
+                    changes.setdefault(path, set())
+            elif line.startswith('@@') and path:
+                match = re.match(r'@@ -(\d+)(?:,(\d+))? \+\d+(?:,(\d+))? @@', line)
+                if match:
+                    replacing = False
+                    old_line = int(match.group(1))
+                    old_count = int(match.group(2) or 1)
+                    new_count = int(match.group(3) or 1)
+                    if not old_count:
+                        # lines inserted after old_line
+                        old_line += 1
+        for lines in changes.values():
+            lines.discard(0)
+        return changes
+
+    @staticmethod
+    def write_lcov(index, output):
+        """Write LCOV report of the index: number of tests which executed
+        each executable line of recorded files
+        """
+        with open(output, 'w') as f:
+            for path in sorted(index.get('files', {})):
+                if not os.path.isfile(path):
+                    continue
+                tests_by_lines = index['files'][path]
+                with open(path, 'rb') as source:
+                    code = compile(source.read(), path, 'exec')
+                lines = set(int(line) for line in tests_by_lines)
+                codes = [code]
+                while codes:
+                    code = codes.pop()
+                    lines.update(line for start, end, line in code.co_lines() if line)
+                    codes.extend(const for const in code.co_consts
+                                 if isinstance(const, types.CodeType))
+                f.write('TN:\nSF:%s\n' % os.path.abspath(path))
+                hit = 0
+                for line in sorted(lines):
+                    count = len(tests_by_lines.get(str(line), ()))
+                    hit += bool(count)
+                    f.write('DA:%d,%d\n' % (line, count))
+                f.write('LF:%d\nLH:%d\nend_of_record\n' % (len(lines), hit))
+
+
+class Benchmark:
+    """Runs bench_ methods: warms them up, calibrates number of calls per
+    round, so round lasts at least round_time, and measures rounds with
+    garbage collector disabled. If baseline is given, benchmark whose
+    median regressed beyond tolerance fails.
+
+    :param baseline:
+        dict of stats by benchmarks ids, saved by previous run
+    :param tolerance:
+        allowed regression of median, as a fraction of baseline median
+    """
+    #: seconds of calling benchmark before measuring
+    warmup_time = 0.1
+    #: minimal seconds of one measured round
+    round_time = 0.01
+    #: seconds of measuring, if rounds are long enough
+    max_time = 1.0
+    min_rounds = 5
+    max_rounds = 1000
+
+    def __init__(self, baseline=None, tolerance=0.1):
+        self.baseline = baseline or {}
+        self.tolerance = tolerance
+
+    def run(self, func, rounds=None):
+        """Measure func, return dict of its stats in seconds per call. Number
+        of rounds is fitted to max_time, if not given.
+        """
+        deadline = time.perf_counter() + self.warmup_time
+        func()
+        while time.perf_counter() < deadline:
+            func()
+
+        loops = 1
+        elapsed = self._measure(func, loops)
+        while elapsed < self.round_time:
+            if elapsed:
+                loops = max(loops * 2, int(loops * self.round_time * 1.2 / elapsed))
+            else:
+                loops *= 10
+            elapsed = self._measure(func, loops)
+
+        if not rounds:
+            rounds = min(self.max_rounds, max(self.min_rounds, int(self.max_time / elapsed)))
+        times = [self._measure(func, loops) / loops for i in range(rounds)]
+        median = statistics.median(times)
+        return {
+            'min': min(times),
+            'max': max(times),
+            'median': median,
+            'stddev': statistics.stdev(times) if rounds > 1 else 0.0,
+            'ops': 1 / median if median else 0.0,
+            'rounds': rounds,
+            'loops': loops,
+        }
+
+    def check(self, bench_id, stats):
+        """Raise AssertionError if benchmark regressed comparing to baseline"""
+        baseline = self.baseline.get(bench_id)
+        if not baseline or not baseline['median']:
+            return None
+        change = stats['median'] / baseline['median'] - 1
+        if change > self.tolerance:
+            raise AssertionError('Benchmark regressed by %.1f%% (median %s, baseline %s, '
+                                 'tolerance %.1f%%)' % (
+                                     change * 100, format_time(stats['median']),
+                                     format_time(baseline['median']), self.tolerance * 100))
+
+    def _measure(self, func, loops):
+        gc_enabled = gc.isenabled()
+        gc.collect()
+        gc.disable()
+        try:
+            timer = time.perf_counter
+            start_time = timer()
+            for i in range(loops):
+                func()
+            return timer() - start_time
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+
+def format_time(seconds):
+    """Format time in seconds with the best fitting unit"""
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '%.2f %s' % (seconds / scale, unit)
+    return '%.2f ns' % (seconds / 1e-9)
+
+
+def format_size(size):
+    """Format size in bytes with the best fitting unit"""
+    for unit, scale in (('MiB', 1024 ** 2), ('KiB', 1024)):
+        if abs(size) >= scale:
+            return '%.1f %s' % (size / scale, unit)
+    return '%d B' % size
 
 
 class Runner:
     """Parse script arguments and run tests"""
     test_method_prefix = 'it_'
+    bench_method_prefix = 'bench_'
     spec_file_prefix = 'spec_'
     behavior_cls = Behavior
+    #: patterns of directories names or paths, which are not searched for specs
+    ignore_patterns = ('.*', '__pycache__', 'node_modules', 'venv', '*.egg-info')
+    #: number of the slowest tests to report
+    durations = 0
+    #: tests running longer (in seconds) are reported as candidates for @slow
+    slow_threshold = 1.0
+    #: run only tests which failed in the previous runs
+    last_failed = False
+    #: run tests which failed in the previous runs first
+    failed_first = False
+    #: path of JUnit XML file
+    junit_output = 'output.xml'
+    #: time limit (in seconds) of tests without @timeout
+    timeout = None
+    #: number of hotspots to report when profiling, 0 disables profiling
+    profile = 0
+    #: retained memory (in bytes) above which tests are reported,
+    #: 0 disables memory checking
+    memcheck = 0
+    #: Benchmark running bench_ methods instead of tests
+    benchmark = None
+    #: (index, count) of the shard to run, index starts from 1
+    shard = None
+    #: path of timings file used to balance shards, tests are
+    #: balanced by their number if not given
+    shard_timings = None
+    #: record lines executed by each test in the index of coverage
+    coverage = False
+    #: path of LCOV report written from the index of coverage
+    coverage_report = None
+    #: path of unified diff (or '-' for stdin), only tests which executed
+    #: lines changed by it (and tests missing in the index) are run
+    affected_by = None
+    #: number of times failed tests are run again, tests which pass are flaky
+    rerun_failures = 0
+    #: ids or glob patterns of quarantined tests, their failures do not fail the run
+    quarantine = ()
+    #: skip behaviors which passed, if their spec file and project
+    #: modules imported by it did not change
+    incremental = False
+    #: maximal number of concurrent async tests running at once
+    concurrency = 10
+    #: run tests in workers forked from the runner process
+    fork_server = False
+    #: modules imported before workers are forked
+    preload = ()
+    #: import spec modules before workers are forked
+    preload_specs = False
+    #: number of tests after which forked worker is replaced, 0 for never
+    recycle_after = 0
+    #: decorators recognized when collecting tests without importing
+    markers = ('only', 'skip', 'slow', 'timeout', 'concurrent')
+    #: attributes of the runner, which are set on runners of worker processes
+    worker_settings = ('timeout', 'profile', 'memcheck', 'benchmark', 'concurrency', 'coverage')
 
     def __init__(self):
         self.loaded_tests = []
         self.only_mode = False
+        self.importers = ftypes.DependencyGraph()
+        self._imports_cache = {}
+        self.storage = Storage()
+        self.watchdog = Watchdog()
+        self.profiler = None
+        self.memory_checker = None
+        self.line_coverage = None
+        # ids of tests affected by the diff, and all tests of the index
+        self.affected_tests = None
+        # top level behaviors (module name, class name) of the shard
+        self.shard_classes = None
+        # spec files which were imported to collect their tests
+        self.imported_spec_files = set()
+        # (path, mtime, digest) of project files, by paths
+        self._digests_cache = {}
+        # state of incremental run, set by select_cached
+        self._incremental = None
 
     def is_behavior_class(self, obj):
         return inspect.isclass(obj) and \
@@ -371,13 +1711,154 @@ class Runner:
         return inspect.isfunction(obj) and \
             obj.__name__.startswith(self.test_method_prefix)
 
-    def get_spec_modules(self):
+    def get_spec_files(self):
+        """Get paths of spec files. Directories matching ignore patterns are
+        not searched. Content of directories which were not modified since
+        the previous run is taken from the cache.
+        """
+        ignore_patterns = list(self.ignore_patterns)
+        cache = self.storage.load('discovery', {})
+        if cache.get('ignore_patterns') != ignore_patterns:
+            cache = {'ignore_patterns': ignore_patterns, 'dirs': {}}
+        dirs = {}
+        spec_files = []
+        pending = ['.']
+        while pending:
+            path = pending.pop()
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            entry = cache['dirs'].get(path)
+            if not entry or entry[0] != mtime:
+                entry = [mtime] + self._scan_directory(path)
+            dirs[path] = entry
+            spec_files.extend(os.path.normpath(os.path.join(path, fn)) for fn in entry[1])
+            pending.extend(os.path.join(path, dn) for dn in entry[2])
+
+        if dirs != cache['dirs']:
+            cache['dirs'] = dirs
+            self.storage.save('discovery', cache)
+        return sorted(spec_files)
+
+    def _scan_directory(self, path):
+        """Return names of spec files and not ignored subdirectories"""
+        spec_files = []
+        subdirs = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    relpath = os.path.normpath(entry.path)
+                    if not any(fnmatch.fnmatch(entry.name, pattern) or
+                               fnmatch.fnmatch(relpath, pattern)
+                               for pattern in self.ignore_patterns):
+                        subdirs.append(entry.name)
+                elif fnmatch.fnmatch(entry.name, '%s*.py' % self.spec_file_prefix) \
+                        and entry.is_file():
+                    spec_files.append(entry.name)
+        return [spec_files, subdirs]
+
+    def get_spec_modules(self, spec_files=None):
         """Get modules to tests"""
-        files = glob('**/%s*.py' % self.spec_file_prefix)
-        for fn in files:
-            fn = fn.replace(os.path.sep, '.')
-            mn = re.sub('\.py$', '', fn)
-            yield importlib.import_module(mn)
+        if spec_files is None:
+            spec_files = self.get_spec_files()
+        for fn in spec_files:
+            yield importlib.import_module(self.get_module_name(fn))
+
+    def get_module_name(self, path):
+        """Convert python file path, relative to the current
+        working directory, to the module name.
+        """
+        mn = re.sub('\.py$', '', os.path.normpath(path))
+        mn = re.sub('(^|%s)__init__$' % re.escape(os.path.sep), '', mn)
+        return mn.replace(os.path.sep, '.')
+
+    def get_module_file(self, module_name):
+        """Get file of the module, if it is placed in the current
+        working directory.
+        """
+        path = module_name.replace('.', os.path.sep)
+        for fn in (path + '.py', os.path.join(path, '__init__.py')):
+            if os.path.isfile(fn):
+                return fn
+        return None
+
+    def is_spec_module(self, module_name):
+        return module_name.rpartition('.')[2].startswith(self.spec_file_prefix)
+
+    def get_module_imports(self, module_name, path):
+        """Get names of modules imported by given module, parsed from
+        its source. Results are cached until the file changes.
+        """
+        mtime = os.path.getmtime(path)
+        cached = self._imports_cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        with open(path, 'rb') as f:
+            tree = ast.parse(f.read(), path)
+        if os.path.basename(path) == '__init__.py':
+            package = module_name
+        else:
+            package = module_name.rpartition('.')[0]
+        names = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names.update(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                base = '.' * node.level + (node.module or '')
+                try:
+                    base = importlib.util.resolve_name(base, package)
+                except (ImportError, ValueError):
+                    continue
+                names.add(base)
+                # from package import module
+                names.update(base + '.' + alias.name for alias in node.names)
+        self._imports_cache[path] = (mtime, names)
+        return names
+
+    def get_importers_graph(self, spec_files):
+        """Build graph of project modules imported by spec modules, directly
+        or through other modules, in which every module points to the
+        modules importing it. Modules are not imported, their imports
+        are parsed from sources.
+        """
+        graph = ftypes.DependencyGraph()
+        pending = [self.get_module_name(fn) for fn in spec_files]
+        visited = set(pending)
+        while pending:
+            name = pending.pop()
+            path = self.get_module_file(name)
+            if not path:
+                continue
+            for imported in self.get_module_imports(name, path):
+                if imported == name or not self.get_module_file(imported):
+                    continue
+                graph.setdefault(imported, []).append(name)
+                if imported not in visited:
+                    visited.add(imported)
+                    pending.append(imported)
+        return graph
+
+    def get_affected_modules(self, filenames, importers):
+        """Get names of changed modules and modules which depend on
+        them, directly or through imports.
+        """
+        changed = set()
+        for fn in filenames:
+            if fn.endswith('.py'):
+                changed.add(self.get_module_name(os.path.relpath(fn)))
+        return set(importers.list(*sorted(changed)))
+
+    def get_git_changed_files(self, ref):
+        """Get files changed since given git reference, including
+        not committed and untracked ones.
+        """
+        changed = subprocess.check_output(
+            ['git', 'diff', '--name-only', '--relative', ref], universal_newlines=True)
+        untracked = subprocess.check_output(
+            ['git', 'ls-files', '--others', '--exclude-standard'], universal_newlines=True)
+        return changed.split() + untracked.split()
 
     def get_behavior_classes(self, module):
         for attr_name in dir(module):
@@ -385,42 +1866,1326 @@ class Runner:
             if self.is_behavior_class(attr):
                 yield attr
 
-    def load_tests(self, behavior_class, results: Results):
-        """Load tests from behavior class"""
+    def load_tests(self, behavior_class, results: Results, parent_behaviors=()):
+        """Load tests from behavior class, nested in given parent behavior
+        classes, into the test plan
+        """
         if hasattr(behavior_class, '_only_mode'):
             self.only_mode = True
+        # shared by all tests of the class
+        behaviors = tuple(behavior.__name__ for behavior in parent_behaviors) + \
+            (behavior_class.__name__,)
         for attr_name in dir(behavior_class):
             if attr_name.startswith('_'):
                 continue
             attr = getattr(behavior_class, attr_name)
             if self.is_test_function(attr):
-                behavior = behavior_class(attr_name, results)
-                self.loaded_tests.append(behavior)
+                self.loaded_tests.append(
+                    PlannedTest(behavior_class, parent_behaviors, attr_name, behaviors))
                 if hasattr(attr, '_only_mode'):
                     self.only_mode = True
             elif self.is_behavior_class(attr):
-                attr.parent_behaviors = \
-                    behavior_class.parent_behaviors + (behavior_class,)
-                self.load_tests(attr, results)
+                self.load_tests(attr, results, parent_behaviors + (behavior_class,))
+
+    def make_results(self, junit=False, stream=None):
+        results = JunitResults(stream, self.junit_output) if junit else Results(stream)
+        results.profiler = self.profiler
+        results.memory_checker = self.memory_checker
+        results.benchmark = self.benchmark
+        results.line_coverage = self.line_coverage
+        return results
+
+    def phase(self, name):
+        """Measure time of runner's own work, when profiling"""
+        if self.profiler:
+            return self.profiler.phase(name)
+        return contextlib.nullcontext()
+
+    def load_modules(self, modules, results: Results):
+        """Load tests from spec modules, return top level behavior classes"""
+        self.loaded_tests = []
+        self.only_mode = False
+        behavior_classes = []
+        for module in modules:
+            for BClass in self.get_behavior_classes(module):
+                self.load_tests(BClass, results)
+                behavior_classes.append(BClass)
+        results.all = len(self.loaded_tests)
+        return behavior_classes
 
-    def run(self, fast_mode=False, junit=False):
-        """Looking for behavior subclasses in modules"""
-        results = JunitResults() if junit else Results()
+    def run(self, fast_mode=False, junit=False, jobs=1, changed_files=None):
+        """Looking for behavior subclasses in modules. If changed_files
+        given, only spec modules which depend on them are loaded.
+        """
+        self.profiler = Profiler() if self.profile else None
+        self.memory_checker = MemoryChecker(self.memcheck) if self.memcheck else None
+        self.line_coverage = LineCoverage() if self.coverage else None
+        with self.phase('discovery'):
+            spec_files = self.get_selected_spec_files(changed_files)
+        if self.affected_by:
+            self.affected_tests = self.get_affected_tests(self.affected_by)
+        if self.shard:
+            with self.phase('collection'):
+                self.shard_classes = self.get_shard_classes(spec_files)
+            shard_modules = set(module_name for module_name, class_name in self.shard_classes)
+            # behaviors of imported spec modules can be defined in other modules
+            spec_files = [fn for fn in spec_files if self.get_module_name(fn) in shard_modules or
+                          fn in self.imported_spec_files]
+        if jobs > 1 or self.fork_server:
+            self.run_parallel(spec_files, jobs, fast_mode, junit)
+        else:
+            with self.phase('imports'):
+                modules = list(self.get_spec_modules(spec_files))
+            self.run_modules(modules, fast_mode, junit)
+
+    def get_selected_spec_files(self, changed_files=None):
+        spec_files = self.get_spec_files()
+        if changed_files is not None:
+            self.importers = self.get_importers_graph(spec_files)
+            affected = self.get_affected_modules(changed_files, self.importers)
+            spec_files = [fn for fn in spec_files
+                          if self.get_module_name(fn) in affected]
+        return spec_files
+
+    def run_modules(self, modules, fast_mode=False, junit=False):
+        """Run tests from given modules in the current process"""
+        results = self.make_results(junit)
         start_time = time.time()
         # Load tests
-        for module in self.get_spec_modules():
-            for BClass in self.get_behavior_classes(module):
-                self.load_tests(BClass, results)
+        with self.phase('load tests'):
+            self.load_modules(modules, results)
+        failed = set(self.storage.load('failures', []))
+        self.loaded_tests = self.select_tests(self.loaded_tests, failed)
         results.all = len(self.loaded_tests)
+        if self.incremental:
+            self.loaded_tests = self.select_cached(self.loaded_tests, results, fast_mode)
 
         # Run tests
-        for behavior in self.loaded_tests:
-            behavior.run(self.only_mode, fast_mode)
+        self.run_tests(self.loaded_tests, results, fast_mode)
+        self.handle_failures(results, fast_mode)
 
-        # Print results
-        stop_time = time.time()
-        time_taken = stop_time - start_time
-        results.print(time_taken)
+        self.finish(results, start_time, failed)
+
+    def run_tests(self, tests, results: Results, fast_mode=False):
+        """Run planned tests, calling before_all and after_all methods once
+        per behavior class, around all of its tests (also nested ones).
+        Behavior instances are created just before their tests are run.
+        """
+        # stack of [behavior class, fixture, exc_info] for current behaviors
+        fixtures = []
+        try:
+            for group in self._group_concurrent(tests, results, fast_mode):
+                behavior = group[0]
+                if behavior.get_skip_reason(self.only_mode, fast_mode):
+                    behavior.run(self.only_mode, fast_mode)
+                    continue
+
+                chain = behavior.parent_behaviors + (behavior.__class__,)
+                common = 0
+                while common < min(len(fixtures), len(chain)) and \
+                        fixtures[common][0] is chain[common]:
+                    common += 1
+                while len(fixtures) > common:
+                    self._call_after_all(fixtures.pop(), results)
+                for behavior_class in chain[common:]:
+                    fixtures.append(self._call_before_all(behavior_class, fixtures, results))
+
+                exc_info = next((fixture[2] for fixture in fixtures if fixture[2]), None)
+                if exc_info:
+                    for behavior in group:
+                        results.add_executed()
+                        results.add_failure(exc_info, behavior)
+                        results.stop_test(behavior)
+                    continue
+                for behavior in group:
+                    vars(behavior).update(fixtures[-1][1]._shared)
+                if len(group) > 1:
+                    self.run_concurrently(group, results)
+                else:
+                    behavior.run(self.only_mode, fast_mode, self.timeout, self.watchdog)
+                # release instances before the next test
+                group = behavior = None
+        finally:
+            while fixtures:
+                self._call_after_all(fixtures.pop(), results)
+
+    def _group_concurrent(self, tests, results, fast_mode):
+        """Yield lists of behavior instances of tests run together:
+        consecutive concurrent tests of the same behavior class, or single
+        tests. Tests are not run concurrently when they are profiled,
+        memory checked, benchmarked or their coverage is recorded.
+        """
+        if results.profiler or results.memory_checker or results.benchmark or \
+                results.line_coverage:
+            for test in tests:
+                yield [test.create(results)]
+            return None
+        group = []
+        for test in tests:
+            behavior = test.create(results)
+            if group and (test.behavior_class, test.parent_behaviors) != \
+                    (group[0].__class__, group[0].parent_behaviors):
+                yield group
+                group = []
+            if behavior.is_concurrent() and \
+                    not behavior.get_skip_reason(self.only_mode, fast_mode):
+                group.append(behavior)
+            else:
+                if group:
+                    yield group
+                    group = []
+                yield [behavior]
+        if group:
+            yield group
+
+    def run_concurrently(self, behaviors, results: Results):
+        """Run async tests as tasks of the event loop of results, at most
+        concurrency of them at once
+        """
+        async def run_all():
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def run(behavior):
+                async with semaphore:
+                    await behavior.run_async(self.timeout)
+            await asyncio.gather(*(run(behavior) for behavior in behaviors))
+
+        with contextlib.ExitStack() as capture:
+            if results.capture_output:
+                capture.enter_context(contextlib.redirect_stdout(TaskOutput(sys.stdout, 0)))
+                capture.enter_context(contextlib.redirect_stderr(TaskOutput(sys.stderr, 1)))
+            try:
+                results.get_loop().run_until_complete(run_all())
+            finally:
+                mock.patch.stopall()
+
+    def _call_before_all(self, behavior_class, fixtures, results):
+        """Call before_all on the fixture instance of behavior class.
+        Attributes it sets, together with ones set by parent behaviors,
+        are shared with tests.
+        """
+        fixture = behavior_class('before_all', results,
+                                 tuple(fixture[0] for fixture in fixtures))
+        initial = set(vars(fixture))
+        exc_info = None
+        if fixtures:
+            vars(fixture).update(fixtures[-1][1]._shared)
+            # failure of parent before_all is passed to nested behaviors
+            exc_info = fixtures[-1][2]
+        if not exc_info:
+            try:
+                with self.phase('before_all'):
+                    fixture._await(behavior_class.before_all(fixture))
+            except:
+                exc_info = sys.exc_info()
+        fixture._shared = {name: value for name, value in vars(fixture).items()
+                           if name not in initial}
+        return [behavior_class, fixture, exc_info]
+
+    def _call_after_all(self, fixture, results):
+        behavior_class, fixture, exc_info = fixture
+        if exc_info:
+            return None
+        fixture.method_name = 'after_all'
+        try:
+            with self.phase('after_all'):
+                fixture._await(behavior_class.after_all(fixture))
+        except:
+            results.add_failure(sys.exc_info(), fixture)
+
+    def run_parallel(self, spec_files, jobs, fast_mode=False, junit=False):
+        """Run tests in a pool of processes, or in processes forked from
+        the current one in fork server mode. Work is sharded by top level
+        behavior classes, so before / after methods of nested behaviors
+        are called in the same process as tests. Shards are planned from
+        collected tests, without importing spec modules.
+        """
+        results = self.make_results(junit)
+        start_time = time.time()
+        with self.phase('collection'):
+            tests = self.collect_tests(spec_files)
+            self.only_mode = any('only' in test.markers for test in tests)
+            failed = set(self.storage.load('failures', []))
+            tests = self.select_tests(tests, failed)
+            results.all = len(tests)
+            if self.incremental:
+                tests = self.select_cached(tests, results, fast_mode)
+            shards = self.get_shards(tests, self.storage.load('timings', {}), failed)
+        timed_out = set()
+        with tempfile.TemporaryDirectory() as dumps_dir:
+            if self.fork_server:
+                with self.phase('imports'):
+                    self.preload_modules(shards)
+                self._run_forked(shards, jobs, fast_mode, junit, results, dumps_dir, timed_out)
+            while shards and not self.fork_server:
+                shards = self._run_pool(shards, jobs, fast_mode, junit, results,
+                                        dumps_dir, timed_out)
+        self.handle_failures(results, fast_mode, jobs)
+
+        self.finish(results, start_time, failed)
+
+    def handle_failures(self, results: Results, fast_mode=False, jobs=None):
+        """Put aside failures of quarantined tests, and run failed tests
+        again if rerun_failures is set (in new worker processes if jobs
+        are given).
+        """
+        if self.quarantine:
+            quarantined = [failure for failure in results.failures
+                           if self.is_quarantined(failure[1].id)]
+            results.failures = [failure for failure in results.failures
+                                if failure not in quarantined]
+            results.quarantined.extend(quarantined)
+        if self.rerun_failures and results.failures:
+            with self.phase('reruns'):
+                self.rerun_failed(results, fast_mode, jobs)
+
+    def is_quarantined(self, test_id):
+        return any(fnmatch.fnmatchcase(test_id, pattern) for pattern in self.quarantine)
+
+    def rerun_failed(self, results: Results, fast_mode=False, jobs=None):
+        """Run failed tests again, at most rerun_failures times. Failures
+        of tests which pass are moved to flaky ones. Numbers of flaky and
+        consistent failures of tests are stored in history.
+        """
+        if jobs is None:
+            failed = set(info.id for err, info in results.failures)
+            planned = [test for test in self.loaded_tests if test.id in failed]
+            remaining = set(test.id for test in planned)
+        else:
+            # failures of after_all methods or worker processes are not run again
+            remaining = set(info.id for err, info in results.failures
+                            if info.method_name.startswith(self.test_method_prefix))
+        flaky = set()
+        for attempt in range(self.rerun_failures):
+            if not remaining:
+                break
+            rerun_results = Results(stream=io.StringIO())
+            rerun_results.show_progress = False
+            if jobs is None:
+                self.run_tests([test for test in planned if test.id in remaining],
+                               rerun_results, fast_mode)
+            else:
+                self._rerun_in_workers(remaining, jobs, fast_mode, rerun_results)
+            failed_again = set(info.id for err, info in rerun_results.failures)
+            passed = set(test_id for test_id in remaining
+                         if test_id in rerun_results.durations and test_id not in failed_again)
+            flaky |= passed
+            remaining -= passed
+
+        results.flaky.extend(failure for failure in results.failures if failure[1].id in flaky)
+        results.failures = [failure for failure in results.failures
+                            if failure[1].id not in flaky]
+        history = self.storage.load('flaky', {})
+        for test_id, kind in [(test_id, 'flaky') for test_id in flaky] + \
+                [(test_id, 'failed') for test_id in remaining]:
+            entry = history.setdefault(test_id, {'flaky': 0, 'failed': 0})
+            entry[kind] += 1
+            entry['last_' + kind] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.storage.save('flaky', history)
+
+    def _rerun_in_workers(self, test_ids, jobs, fast_mode, results):
+        """Run tests in a new pool of worker processes"""
+        shards = {}
+        for test_id in test_ids:
+            info = TestInfo.from_id(test_id)
+            shards.setdefault((info.module, info.behaviors[0]), set()).add(test_id)
+        shards = [key + (ids, len(ids)) for key, ids in sorted(shards.items())]
+        results.all = len(test_ids)
+        with tempfile.TemporaryDirectory() as dumps_dir:
+            while shards:
+                shards = self._run_pool(shards, max(jobs, 1), fast_mode, False, results,
+                                        dumps_dir, set())
+
+    def preload_modules(self, shards):
+        """Import modules given to preload, and spec modules of shards
+        if preload_specs is set, before workers are forked.
+        """
+        names = list(self.preload)
+        if self.preload_specs:
+            names += sorted(set(module_name for module_name, class_name, test_ids, planned
+                                in shards))
+        for name in names:
+            importlib.import_module(name)
+
+    def _run_pool(self, shards, jobs, fast_mode, junit, results, dumps_dir, timed_out):
+        """Run shards in a pool of processes. If a worker process exited,
+        because its test did not respond to timeout, the test fails and
+        shards which did not finish are returned, to be run in a new pool
+        without timed out tests.
+        """
+        unfinished = []
+        error = None
+        with futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            submitted = {}
+            for shard in shards:
+                args = self._get_shard_args(shard, fast_mode, junit, dumps_dir, timed_out)
+                submitted[executor.submit(_run_shard, args)] = shard
+            for future in futures.as_completed(submitted):
+                shard = submitted[future]
+                if isinstance(future.exception(), futures.process.BrokenProcessPool):
+                    error = future.exception()
+                    unfinished.append(shard)
+                    continue
+                summary = future.result()
+                # collected tests may differ from loaded ones
+                results.all += summary['loaded'] - shard[3]
+                results.merge(summary)
+                results.print_progress()
+        if not unfinished:
+            return []
+
+        dumps = self._read_dumps(dumps_dir)
+        if not dumps:
+            raise error
+        for test_id, dump in dumps.items():
+            timed_out.add(test_id)
+            self._add_timed_out(results, test_id, dump)
+        # timed out tests are already counted
+        return [(module_name, class_name, test_ids, planned - sum(
+                    test_id.startswith('%s:%s.' % (module_name, class_name))
+                    for test_id in dumps))
+                for module_name, class_name, test_ids, planned in unfinished]
+
+    def _run_forked(self, shards, jobs, fast_mode, junit, results, dumps_dir, timed_out):
+        """Run shards in worker processes forked from the current one, so
+        they share preloaded modules copy-on-write. Results of each test
+        are streamed back over pipes. Worker exits after running
+        recycle_after tests, and a new one is forked when needed. If
+        worker exited, because its test did not respond to timeout, the
+        test fails and the rest of its shard is run by another worker.
+        """
+        context = multiprocessing.get_context('fork')
+        pending = collections.deque(shards)
+        # [process, shard or None if idle, ids of finished tests] by connections
+        workers = {}
+        # tests which are not run again: timed out and finished by exited workers
+        excluded = set(timed_out)
+        while pending or any(worker[1] for worker in workers.values()):
+            idle = [connection for connection, worker in workers.items() if not worker[1]]
+            while pending and (idle or len(workers) < jobs):
+                if idle:
+                    connection = idle.pop()
+                else:
+                    connection, worker_connection = context.Pipe()
+                    # not a daemon, so workers can run specs of the runner itself
+                    process = context.Process(target=_serve_shards,
+                                              args=(worker_connection, self.recycle_after))
+                    process.start()
+                    worker_connection.close()
+                    workers[connection] = [process, None, set()]
+                shard = pending.popleft()
+                workers[connection][1:] = [shard, set()]
+                connection.send(self._get_shard_args(shard, fast_mode, junit, dumps_dir,
+                                                     excluded))
+
+            for connection in multiprocessing.connection.wait(list(workers)):
+                process, shard, finished = workers[connection]
+                try:
+                    message = connection.recv()
+                except EOFError:
+                    message = None
+                if message is None:
+                    del workers[connection]
+                    connection.close()
+                    process.join()
+                    pending.extend(self._recover_shard(shard, finished, process, results,
+                                                       dumps_dir, excluded))
+                    continue
+                if message[0] == 'test':
+                    test_id, summary = message[1:]
+                    finished.add(test_id)
+                    results.merge(summary)
+                else:
+                    summary, exiting = message[1:]
+                    # collected tests may differ from loaded ones
+                    results.all += summary['loaded'] - shard[3]
+                    results.merge(summary)
+                    workers[connection][1] = None
+                    if exiting:
+                        del workers[connection]
+                        connection.close()
+                        process.join()
+                results.print_progress()
+
+        for connection, (process, shard, finished) in workers.items():
+            connection.send(None)
+            connection.close()
+            process.join()
+
+    def _recover_shard(self, shard, finished, process, results, dumps_dir, excluded):
+        """Handle exit of worker process running the shard. If its test
+        did not respond to timeout, the test fails and the rest of the shard
+        is returned to be run again. Otherwise the shard fails.
+        """
+        module_name, class_name, test_ids, planned = shard
+        excluded.update(finished)
+        planned -= len(finished)
+        dumps = self._read_dumps(dumps_dir, [str(process.pid)])
+        if not dumps:
+            # the failure of the worker takes place of its unfinished tests
+            results.all -= planned - 1
+            try:
+                raise RuntimeError('Worker process exited with code %s, the rest of tests '
+                                   'of the behavior were not run' % process.exitcode)
+            except RuntimeError:
+                results.add_executed()
+                results.add_failure(sys.exc_info(), TestInfo(module_name, (class_name,),
+                                                             'worker'))
+            return []
+        for test_id, dump in dumps.items():
+            excluded.add(test_id)
+            self._add_timed_out(results, test_id, dump)
+            planned -= 1
+        return [(module_name, class_name, test_ids, planned)] if planned > 0 else []
+
+    def _get_shard_args(self, shard, fast_mode, junit, dumps_dir, excluded):
+        """Return dict of arguments of _run_shard"""
+        module_name, class_name, test_ids, planned = shard
+        return {
+            'runner_cls': self.__class__,
+            'module_name': module_name,
+            'class_name': class_name,
+            'test_ids': test_ids,
+            'only_mode': self.only_mode,
+            'fast_mode': fast_mode,
+            'junit': junit,
+            'dumps_dir': dumps_dir,
+            'timed_out': frozenset(excluded),
+            'settings': {name: getattr(self, name) for name in self.worker_settings},
+        }
+
+    def _add_timed_out(self, results, test_id, dump):
+        results.add_executed()
+        try:
+            raise TestTimeout('Test did not respond to its time limit, worker process '
+                              'was recycled. Stacks of its threads:\n\n' + dump)
+        except TestTimeout:
+            results.add_failure(sys.exc_info(), TestInfo.from_id(test_id))
+
+    def _read_dumps(self, directory, names=None):
+        """Read files of watchdogs of worker processes (all or with given
+        names). Return dict of stack dumps by ids of tests, which did not
+        respond to timeout.
+        """
+        dumps = {}
+        for name in names or os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not os.path.exists(path):
+                continue
+            with open(path) as f:
+                test_id, _, dump = f.read().partition('\n')
+            if dump:
+                dumps[test_id] = dump
+            os.remove(path)
+        return dumps
+
+    def finish(self, results: Results, start_time, failed):
+        """Print results and store timings and failures of tests, or stats
+        of benchmarks
+        """
+        with self.phase('reporting'):
+            stop_time = time.time()
+            time_taken = stop_time - start_time
+            results.print(time_taken)
+            self.print_durations(results)
+
+            # benchmarks are not tests, they are stored only with their stats
+            if not self.benchmark:
+                timings = self.storage.load('timings', {})
+                timings.update((test_id, [round(wall_time, 6), round(cpu_time, 6)])
+                               for test_id, (wall_time, cpu_time) in results.durations.items())
+                self.storage.save('timings', timings)
+                # failures of tests which were not executed this time are kept
+                failed.difference_update(results.durations)
+                # failures of after_all methods or worker processes are not tests
+                failed.update(info.id for err, info in results.failures
+                              if info.method_name.startswith(self.test_method_prefix))
+                self.storage.save('failures', sorted(failed))
+            if self._incremental:
+                self.save_incremental(results)
+            if self.line_coverage:
+                self.line_coverage.close()
+                index = self.storage.load('coverage', {})
+                index = LineCoverage.update_index(index, self.line_coverage.lines)
+                self.storage.save('coverage', index)
+            if self.coverage_report:
+                LineCoverage.write_lcov(self.storage.load('coverage', {}),
+                                        self.coverage_report)
+        results.close_loop()
+        if self.profiler:
+            self.print_profile(results)
+        if self.memory_checker:
+            self.print_memcheck(results)
+        if self.benchmark:
+            self.print_benchmarks(results)
+            self.storage.save('benchmarks', results.benchmarks)
+
+    def select_tests(self, tests, failed):
+        """Keep only tests of the shard, if given. Keep only previously
+        failed tests in last failed mode (all tests if none of them are
+        planned), or move them to the beginning in failed first mode.
+        Given tests are planned or collected tests. Failed tests missing
+        in their modules (removed or renamed) are removed from failed ones.
+        """
+        modules = set(test.get_info().module for test in tests)
+        test_ids = set(test.get_info().id for test in tests)
+        failed.difference_update([test_id for test_id in failed
+                                  if test_id.partition(':')[0] in modules and
+                                  test_id not in test_ids])
+        if self.shard_classes is not None:
+            tests = [test for test in tests
+                     if (test.get_info().module, test.get_info().behaviors[0]) in
+                     self.shard_classes]
+        if self.affected_tests is not None:
+            affected, indexed = self.affected_tests
+            tests = [test for test in tests
+                     if test.get_info().id in affected or test.get_info().id not in indexed]
+        selected = [test for test in tests if test.get_info().id in failed]
+        if self.last_failed and selected:
+            return selected
+        elif self.failed_first and failed:
+            return sorted(tests, key=lambda test: test.get_info().id not in failed)
+        return tests
+
+    def select_cached(self, tests, results, fast_mode=False):
+        """Skip tests of top level behaviors which passed in a previous
+        run, if their spec file and project modules imported by it, directly
+        or not, did not change since. They are reported as cached. Cache is
+        dropped when Python version or configuration of the run changes.
+        Return tests to run.
+        """
+        if self.only_mode:
+            self._incremental = None
+            return tests
+        config = self.get_incremental_config(fast_mode)
+        cache = self.storage.load('incremental', {})
+        passed = cache.get('behaviors', {}) if cache.get('config') == config else {}
+        # digests of top level behaviors and numbers of their tests
+        digests = {}
+        counts = collections.Counter()
+        module_digests = {}
+        selected = []
+        for test in tests:
+            info = test.get_info()
+            key = '%s:%s' % (info.module, info.behaviors[0])
+            if key not in digests:
+                if info.module not in module_digests:
+                    module_digests[info.module] = self.get_module_digest(info.module)
+                digests[key] = module_digests[info.module]
+            counts[key] += 1
+            if passed.get(key) == digests[key]:
+                results.add_cached(test)
+            else:
+                selected.append(test)
+        self._incremental = (config, passed, digests, counts)
+        return selected
+
+    def save_incremental(self, results):
+        """Store digests of top level behaviors all of which tests passed"""
+        config, passed, digests, counts = self._incremental
+        self._incremental = None
+        executed = collections.Counter(self._get_behavior_key(test_id)
+                                       for test_id in results.durations)
+        failed = set('%s:%s' % (info.module, info.behaviors[0])
+                     for err, info in results.failures)
+        for key, count in counts.items():
+            if executed[key] == count and key not in failed and not self.last_failed:
+                passed[key] = digests[key]
+            elif executed[key] or key in failed:
+                passed.pop(key, None)
+        self.storage.save('incremental', {'config': config, 'behaviors': passed})
+
+    def get_incremental_config(self, fast_mode=False):
+        """Return configuration of the run, change of which drops cache
+        of incremental runs
+        """
+        return [sys.version, self.test_method_prefix, self.behavior_cls.__name__, fast_mode,
+                self.timeout, self.benchmark is not None,
+                self._get_file_digest(os.path.abspath(__file__))]
+
+    def get_module_digest(self, module_name):
+        """Hash content of module file and project modules imported by it,
+        directly or through other modules
+        """
+        paths = []
+        pending = [module_name]
+        visited = set(pending)
+        while pending:
+            name = pending.pop()
+            path = self.get_module_file(name)
+            if not path:
+                continue
+            paths.append(path)
+            for imported in self.get_module_imports(name, path):
+                if imported not in visited:
+                    visited.add(imported)
+                    pending.append(imported)
+        digest = hashlib.sha1()
+        for path in sorted(paths):
+            digest.update(('%s:%s\n' % (path, self._get_file_digest(path))).encode())
+        return digest.hexdigest()
+
+    def _get_file_digest(self, path):
+        mtime = os.path.getmtime(path)
+        cached = self._digests_cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        self._digests_cache[path] = (mtime, digest)
+        return digest
+
+    def _get_behavior_key(self, test_id):
+        module, path = test_id.split(':')
+        return '%s:%s' % (module, path.split('.')[0])
+
+    def get_affected_tests(self, diff_path):
+        """Return ids of tests which executed lines changed by unified diff
+        (read from stdin if path is '-'), and ids of all tests in the index
+        of coverage
+        """
+        if diff_path == '-':
+            diff = sys.stdin.read()
+        else:
+            with open(diff_path) as f:
+                diff = f.read()
+        index = self.storage.load('coverage', {})
+        return (LineCoverage.get_tests(index, LineCoverage.parse_diff(diff)),
+                set(index.get('tests', ())))
+
+    def get_shards(self, tests, timings, failed):
+        """Split collected tests by top level behavior classes. Return list
+        of (module name, class name, test ids, number of tests) tuples,
+        where test ids are given only if single tests were selected (in last
+        failed mode or by affected tests). Behaviors with
+        previously failed tests go first in failed first mode, the longest
+        ones next. Tests without timings get the average time.
+        """
+        average = 0
+        if timings:
+            average = sum(wall_time for wall_time, cpu_time in timings.values()) / len(timings)
+        shards = {}
+        for test in tests:
+            shard = shards.setdefault((test.module, test.behaviors[0]),
+                                      {'ids': set(), 'weight': 0, 'failed': False})
+            shard['ids'].add(test.id)
+            timing = timings.get(test.id)
+            shard['weight'] += timing[0] if timing else average
+            shard['failed'] |= test.id in failed
+
+        keys = list(shards)
+        keys.sort(key=lambda key: (not (self.failed_first and shards[key]['failed']),
+                                   -shards[key]['weight']))
+        filtered = (self.last_failed and failed) or self.affected_tests is not None
+        return [key + (shards[key]['ids'] if filtered else None, len(shards[key]['ids']))
+                for key in keys]
+
+    def get_shard_classes(self, spec_files):
+        """Assign top level behaviors of collected tests to shards and
+        return set of (module name, class name) of the given one. Shards
+        are balanced by timings from shard_timings file, or by number of
+        tests if it's not given. Assignment depends only on tests and the
+        timings file, so it's the same on every machine.
+        """
+        index, count = self.shard
+        timings = {}
+        if self.shard_timings:
+            with open(self.shard_timings) as f:
+                timings = json.load(f)
+        tests = self.collect_tests(spec_files)
+        known = [timings[test.id][0] for test in tests if test.id in timings]
+        average = sum(known) / len(known) if known else 1
+        weights = {}
+        for test in tests:
+            key = (test.module, test.behaviors[0])
+            timing = timings.get(test.id)
+            weights[key] = weights.get(key, 0) + (timing[0] if timing else average)
+
+        # the heaviest behaviors first, each to the least loaded shard
+        loads = [0] * count
+        classes = set()
+        for key in sorted(weights, key=lambda key: (-weights[key], key)):
+            shard = loads.index(min(loads))
+            loads[shard] += weights[key]
+            if shard == index - 1:
+                classes.add(key)
+        return classes
+
+    def print_durations(self, results: Results):
+        """Print the slowest tests and tests which should be marked as slow"""
+        stream = results.stream
+        if self.durations:
+            slowest = sorted(results.durations, key=lambda test_id: results.durations[test_id][0],
+                             reverse=True)[:self.durations]
+            stream.writeln('\nSlowest tests:')
+            for test_id in slowest:
+                wall_time, cpu_time = results.durations[test_id]
+                stream.writeln('  %.3fs (cpu %.3fs) %s' % (
+                    wall_time, cpu_time, TestInfo.from_id(test_id).full_description))
+
+        too_slow = [test_id for test_id, (wall_time, cpu_time) in results.durations.items()
+                    if wall_time > self.slow_threshold and test_id not in results.marked_slow]
+        # benchmarks are expected to be long
+        if too_slow and not self.benchmark:
+            stream.writeln('\nTests slower than %ss, consider marking them with @slow:' %
+                           self.slow_threshold)
+            for test_id in sorted(too_slow):
+                stream.writeln('  %s (%s)' % (TestInfo.from_id(test_id).full_description,
+                                              test_id))
+
+    def print_profile(self, results: Results):
+        """Write stats of profiled tests to pstats file, print the most
+        expensive behaviors and functions, and time of runner's own phases.
+        """
+        stream = results.stream
+        profiler = self.profiler
+        stats = profiler.get_stats()
+        os.makedirs(self.storage.path, exist_ok=True)
+        path = os.path.join(self.storage.path, 'profile.pstats')
+        stats.dump_stats(path)
+        stream.writeln('\nProfile of tests written to %s (python3 -m pstats %s)' % (path, path))
+
+        stream.writeln('\nSlowest behaviors (profiled time):')
+        for behavior_path, seconds in profiler.get_behaviors_times()[:self.profile]:
+            stream.writeln('  %.3fs %s' % (seconds, behavior_path))
+
+        stream.writeln('\nHotspots (own time):')
+        stream.writeln('  %10s %10s %10s  %s' % ('calls', 'own', 'cumulative', 'function'))
+        hotspots = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+        for func, (cc, nc, tt, ct, callers) in hotspots[:self.profile]:
+            stream.writeln('  %10s %9.3fs %9.3fs  %s' % (
+                nc, tt, ct, pstats.func_std_string(pstats.func_strip_path(func))))
+
+        # before_each / after_each methods are profiled with tests
+        phases = dict(profiler.phases)
+        for name, method in (('before_each', Behavior._call_before_each_methods),
+                             ('after_each', Behavior._call_after_each_methods)):
+            code = method.__code__
+            stat = stats.stats.get((code.co_filename, code.co_firstlineno, code.co_name))
+            if stat:
+                phases[name] = stat[3]
+        stream.writeln('\nRunner overhead:')
+        for name in ('discovery', 'collection', 'imports', 'load tests', 'before_all',
+                     'after_all', 'before_each', 'after_each', 'reporting'):
+            if name in phases:
+                stream.writeln('  %-12s %.3fs' % (name, phases[name]))
+        stream.writeln('  %-12s %.3fs' % ('tests', stats.total_tt))
+        stream.writeln('  %-12s %.3fs' % ('total', time.perf_counter() - profiler.start_time))
+
+    def print_memcheck(self, results: Results):
+        """Print tests which retained memory, with allocation sites, and
+        timeline of peak RSS of processes.
+        """
+        stream = results.stream
+        checker = self.memory_checker
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        if checker.leaks:
+            stream.writeln('\nTests retaining more than %.1f KiB:' % (self.memcheck / 1024))
+            for test_id, retained, sites in sorted(checker.leaks, key=lambda leak: leak[1],
+                                                   reverse=True):
+                stream.writeln('  %.1f KiB %s' % (retained / 1024, test_id))
+                for site in sites:
+                    stream.writeln('    %s' % site)
+
+        if checker.timeline:
+            processes = len(set(pid for timestamp, pid, peak_rss, test_id in checker.timeline))
+            stream.writeln('\nPeak RSS timeline:')
+            for timestamp, pid, peak_rss, test_id in sorted(checker.timeline):
+                stream.writeln('  %7.2fs %8.1f MiB %s%s' % (
+                    timestamp - checker.start_time, peak_rss / 1024 / 1024,
+                    '[%s] ' % pid if processes > 1 else '', test_id))
+
+    def print_benchmarks(self, results: Results):
+        """Print stats of benchmarks, with change of median comparing to
+        baseline if given.
+        """
+        stream = results.stream
+        if not results.benchmarks:
+            return None
+        width = max(len(bench_id) for bench_id in results.benchmarks)
+        stream.writeln('\nBenchmarks:')
+        stream.writeln('  %-*s %11s %11s %11s %13s' % (width, '', 'min', 'median', 'stddev',
+                                                       'ops/s'))
+        for bench_id, stats in sorted(results.benchmarks.items()):
+            line = '  %-*s %11s %11s %11s %13.1f' % (
+                width, bench_id, format_time(stats['min']), format_time(stats['median']),
+                format_time(stats['stddev']), stats['ops'])
+            baseline = self.benchmark.baseline.get(bench_id)
+            if baseline and baseline['median']:
+                line += ' (%+.1f%%)' % ((stats['median'] / baseline['median'] - 1) * 100)
+            stream.writeln(line)
+
+    def collect_tests(self, spec_files):
+        """Find tests in spec files by parsing them, without importing.
+        Results are cached by files content hashes. Spec modules with
+        behavior classes, which can't be recognized from the source, are
+        imported to find their tests.
+        """
+        config = [self.test_method_prefix, self.behavior_cls.__name__, list(self.markers)]
+        cache = self.storage.load('collection', {})
+        if cache.get('config') != config:
+            cache = {'config': config, 'files': {}}
+        collection = {}
+        tests = []
+        test_ids = set()
+        for fn in spec_files:
+            with open(fn, 'rb') as f:
+                source = f.read()
+            digest = hashlib.sha1(source).hexdigest()
+            cached = cache['files'].get(fn)
+            if cached and cached[0] == digest:
+                collection[fn] = cached
+            else:
+                collection[fn] = [digest, self.collect_source(source, fn)]
+            module_name = self.get_module_name(fn)
+            if collection[fn][1] is None:
+                self.imported_spec_files.add(fn)
+                for test in self.collect_module(module_name):
+                    # behaviors imported from other spec modules
+                    if test.id not in test_ids:
+                        test_ids.add(test.id)
+                        tests.append(test)
+                continue
+            for behaviors, method_name, markers in collection[fn][1]:
+                test = CollectedTest(module_name, tuple(behaviors), method_name, markers)
+                test_ids.add(test.id)
+                tests.append(test)
+        if collection != cache['files']:
+            cache['files'] = collection
+            self.storage.save('collection', cache)
+        return tests
+
+    def collect_source(self, source, filename='<spec>'):
+        """Parse spec source, return list of [behaviors, method name, markers],
+        or None if it has classes which can't be told to be behaviors or not
+        (their bases are imported under other names or from other modules).
+        """
+        tree = ast.parse(source, filename)
+        # names of behavior classes, which can be used as bases
+        names = {self.behavior_cls.__name__}
+        classes = {}
+        for node in tree.body:
+            if not isinstance(node, ast.ClassDef):
+                continue
+            is_behavior = self._is_behavior_node(node, names, classes)
+            if is_behavior is None:
+                return None
+            if is_behavior:
+                names.add(node.name)
+            else:
+                # name is shadowed by other class
+                names.discard(node.name)
+            classes[node.name] = node
+        tests = []
+        try:
+            for name, node in classes.items():
+                if name in names:
+                    self._collect_class(node, (), set(), names, classes, tests)
+        except LookupError:
+            return None
+        return tests
+
+    def _is_behavior_node(self, node, names, classes):
+        """Check if class node is a behavior, given names of behavior classes
+        and all classes of the module. Return None if it can't be told.
+        """
+        known = True
+        for base in node.bases:
+            if isinstance(base, ast.Attribute) and base.attr == self.behavior_cls.__name__:
+                return True
+            if isinstance(base, ast.Name) and base.id in names:
+                return True
+            if not (isinstance(base, ast.Name) and
+                    (base.id in classes or hasattr(builtins, base.id))):
+                known = False
+        return False if known else None
+
+    def _get_markers(self, node):
+        markers = set()
+        for decorator in node.decorator_list:
+            # decorators with arguments, like @timeout(5)
+            if isinstance(decorator, ast.Call):
+                decorator = decorator.func
+            if isinstance(decorator, ast.Name):
+                name = decorator.id
+            elif isinstance(decorator, ast.Attribute):
+                name = decorator.attr
+            else:
+                continue
+            if name in self.markers:
+                markers.add(name)
+        return markers
+
+    def _get_members(self, node, classes):
+        """Get members of class node by names, also inherited from classes
+        of the same module
+        """
+        members = {}
+        for base in reversed(node.bases):
+            if isinstance(base, ast.Name) and base.id in classes:
+                members.update(self._get_members(classes[base.id], classes))
+        members.update((child.name, child) for child in node.body if hasattr(child, 'name'))
+        return members
+
+    def _collect_class(self, node, behaviors, markers, names, classes, tests):
+        behaviors += (node.name,)
+        markers = markers | self._get_markers(node)
+        members = self._get_members(node, classes)
+        for name in sorted(members):
+            child = members[name]
+            if name.startswith('_'):
+                continue
+            if isinstance(child, ast.ClassDef):
+                is_behavior = self._is_behavior_node(child, names, classes)
+                if is_behavior is None:
+                    raise LookupError(child.name)
+                if is_behavior:
+                    self._collect_class(child, behaviors, markers, names, classes, tests)
+            elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)) and \
+                    name.startswith(self.test_method_prefix):
+                tests.append([list(behaviors), name,
+                              sorted(markers | self._get_markers(child))])
+
+    def collect_module(self, module_name):
+        """Find tests of spec module by importing it. Return list of
+        collected tests.
+        """
+        tests = []
+        module = importlib.import_module(module_name)
+        for behavior_class in self.get_behavior_classes(module):
+            self._collect_behavior(behavior_class, behavior_class.__module__, (), set(), tests)
+        return tests
+
+    def _collect_behavior(self, behavior_class, module_name, behaviors, markers, tests):
+        behaviors += (behavior_class.__name__,)
+        markers = markers | self._get_attribute_markers(behavior_class)
+        for attr_name in dir(behavior_class):
+            if attr_name.startswith('_'):
+                continue
+            attr = getattr(behavior_class, attr_name)
+            if self.is_test_function(attr):
+                tests.append(CollectedTest(
+                    module_name, behaviors, attr_name,
+                    sorted(markers | self._get_attribute_markers(attr))))
+            elif self.is_behavior_class(attr):
+                self._collect_behavior(attr, module_name, behaviors, markers, tests)
+
+    def _get_attribute_markers(self, obj):
+        return set(marker for marker in self.markers
+                   if hasattr(obj, _marker_attributes.get(marker, '_' + marker)))
+
+    def collect(self, changed_files=None, stream=None):
+        """Print tests found in spec files, without importing them"""
+        stream = ColorStream(stream or sys.stdout)
+        spec_files = self.get_selected_spec_files(changed_files)
+        if self.shard:
+            self.shard_classes = self.get_shard_classes(spec_files)
+        if self.affected_by:
+            self.affected_tests = self.get_affected_tests(self.affected_by)
+        tests = self.collect_tests(spec_files)
+        failed = set(self.storage.load('failures', []))
+        tests = self.select_tests(tests, failed)
+        for test in tests:
+            markers = ''.join(' @' + marker for marker in test.markers)
+            stream.writeln(test.id + markers)
+        stream.writeln('%s tests collected' % len(tests))
+
+    def rerun(self, filenames, fast_mode=False, junit=False):
+        """Reload changed modules with modules which import them and
+        run tests from affected spec modules, in the current process.
+        Return False if changed modules can't be reloaded, because
+        they are part of the runner itself.
+        """
+        self.profiler = Profiler() if self.profile else None
+        self.memory_checker = MemoryChecker(self.memcheck) if self.memcheck else None
+        self.line_coverage = LineCoverage() if self.coverage else None
+        filenames = [fn for fn in filenames if os.path.exists(fn)]
+        self.importers = self.get_importers_graph(self.get_spec_files())
+        affected = self.get_affected_modules(filenames, self.importers)
+        runner_modules = {self.__class__.__module__, self.behavior_cls.__module__}
+        runner_files = set(os.path.abspath(sys.modules[name].__file__) for name in runner_modules)
+        if affected & runner_modules or \
+                any(os.path.abspath(fn) in runner_files for fn in filenames):
+            return False
+
+        # Reload dependencies before modules which import them
+        imports = ftypes.DependencyGraph()
+        for name, module_importers in self.importers.items():
+            for importer in module_importers:
+                imports.setdefault(importer, []).append(name)
+        spec_modules = []
+        for name in imports.list(*sorted(affected)):
+            if name not in affected or not self.get_module_file(name):
+                continue
+            if name in sys.modules:
+                module = importlib.reload(sys.modules[name])
+            elif self.is_spec_module(name):
+                module = importlib.import_module(name)
+            else:
+                continue
+            if self.is_spec_module(name):
+                spec_modules.append(module)
+
+        if spec_modules:
+            self.run_modules(spec_modules, fast_mode, junit)
+        return True
+
+
+# files for watchdog dumps of the current worker process, by paths
+_dump_files = {}
+
+
+def _serve_shards(connection, recycle_after):
+    """Run shards received over connection in a forked worker process,
+    streaming results of each test back. Exit after running recycle_after
+    tests, if given.
+    """
+    tests_run = 0
+    while True:
+        try:
+            args = connection.recv()
+        except EOFError:
+            # runner process exited
+            break
+        if args is None:
+            break
+        summary = _run_shard(args, connection)
+        tests_run += summary['loaded']
+        exiting = bool(recycle_after) and tests_run >= recycle_after
+        connection.send(('done', summary, exiting))
+        if exiting:
+            break
+    connection.close()
+
+
+def _run_shard(args, sink=None):
+    """Run tests of one top level behavior class in a worker process.
+    Args are a dict given by Runner._get_shard_args, of which only runner
+    class, module name, class name and dumps directory are required. If sink
+    connection is given, summary of each test is sent to it.
+    """
+    runner = args['runner_cls']()
+    for name, value in args.get('settings', {}).items():
+        setattr(runner, name, value)
+    runner.line_coverage = LineCoverage() if runner.coverage else None
+    if runner.benchmark:
+        runner.test_method_prefix = runner.bench_method_prefix
+    runner.profiler = Profiler() if runner.profile else None
+    runner.memory_checker = MemoryChecker(runner.memcheck) if runner.memcheck else None
+    # progress is printed and JUnit file written by the parent process
+    runner.junit_output = None
+    path = os.path.join(args['dumps_dir'], str(os.getpid()))
+    if path not in _dump_files:
+        _dump_files[path] = open(path, 'w')
+    runner.watchdog = Watchdog(_dump_files[path], exit=True)
+    results = runner.make_results(args.get('junit', False), stream=io.StringIO())
+    results.show_progress = False
+    results.sink = sink
+    with runner.phase('imports'):
+        behavior_class = getattr(importlib.import_module(args['module_name']),
+                                 args['class_name'], None)
+    with runner.phase('load tests'):
+        if runner.is_behavior_class(behavior_class):
+            runner.load_tests(behavior_class, results)
+    test_ids = args.get('test_ids')
+    if test_ids is not None:
+        runner.loaded_tests = [test for test in runner.loaded_tests if test.id in test_ids]
+    timed_out = args.get('timed_out')
+    if timed_out:
+        runner.loaded_tests = [test for test in runner.loaded_tests
+                               if test.id not in timed_out]
+    results.all = len(runner.loaded_tests)
+    runner.only_mode = args.get('only_mode', False)
+    runner.run_tests(runner.loaded_tests, results, args.get('fast_mode', False))
+    results.close_loop()
+    if runner.line_coverage:
+        runner.line_coverage.close()
+    summary = results.get_summary()
+    summary['loaded'] = results.all
+    return summary
+
+
+def _equals(a, b):
+    """Compare values, also ones compared element-wise (like NumPy arrays)"""
+    if a is b:
+        return True
+    result = a == b
+    if isinstance(result, bool):
+        return result
+    try:
+        return bool(result)
+    except ValueError:
+        # truth value of element-wise comparison is ambiguous
+        return getattr(a, 'shape', None) == getattr(b, 'shape', None) and bool(result.all())
+
+
+def _is_array(value):
+    return type(value).__module__ == 'numpy' and hasattr(value, 'shape')
+
+
+class Difference:
+    """Message of failed expect(a) == b assertion. Describes where values
+    differ: first differing index or key, length mismatch and missing or
+    unexpected items, descending into nested containers. Its size is bounded
+    and it is computed only when converted to string.
+    """
+    #: number of items listed in summaries
+    max_items = 5
+    #: number of nested containers descended into
+    max_depth = 5
+    #: number of items of lists compared at once, before looking for the item
+    chunk_size = 1024
+    _repr = reprlib.Repr()
+    _repr.maxlevel = 3
+    _repr.maxstring = _repr.maxother = 80
+    _repr.maxlist = _repr.maxtuple = _repr.maxdict = _repr.maxset = \
+        _repr.maxfrozenset = _repr.maxdeque = 10
+
+    def __init__(self, expected, given):
+        self.expected = expected
+        self.given = given
+        self._text = None
+
+    def __str__(self):
+        if self._text is None:
+            try:
+                self._text = '\n'.join(self.describe())
+            except Exception:
+                # values which can't be described are only shown
+                self._text = 'expected %s, given %s' % (self.format(self.expected),
+                                                        self.format(self.given))
+            self.expected = self.given = None
+        return self._text
+
+    def format(self, value):
+        """Return bounded text of value"""
+        if isinstance(value, str):
+            if len(value) > self._repr.maxstring:
+                return value[:self._repr.maxstring] + '...'
+            return value
+        return self._repr.repr(value)
+
+    def describe(self):
+        expected, given = self.expected, self.given
+        lines = ['expected %s, given %s' % (self.format(expected), self.format(given))]
+        path = ''
+        for depth in range(self.max_depth):
+            details, key = self._compare(expected, given)
+            lines.extend('  ' + line for line in details)
+            if key is None:
+                break
+            expected, given = expected[key], given[key]
+            path += '[%s]' % self._repr.repr(key)
+            lines.append('at %s: expected %s, given %s' % (
+                path, self.format(expected), self.format(given)))
+        return lines
+
+    def _compare(self, expected, given):
+        """Return lines describing difference of values, and index or key
+        of the first differing nested item to descend into (or None).
+        """
+        if isinstance(expected, (str, bytes)) and type(expected) is type(given):
+            return self._compare_strings(expected, given), None
+        if _is_array(expected) and _is_array(given):
+            return self._compare_arrays(expected, given), None
+        if isinstance(expected, collections.abc.Mapping) and \
+                isinstance(given, collections.abc.Mapping):
+            return self._compare_mappings(expected, given)
+        if isinstance(expected, collections.abc.Set) and \
+                isinstance(given, collections.abc.Set):
+            return self._compare_sets(expected, given), None
+        if isinstance(expected, collections.abc.Sequence) and \
+                isinstance(given, collections.abc.Sequence) and \
+                not isinstance(expected, (str, bytes)) and not isinstance(given, (str, bytes)):
+            return self._compare_sequences(expected, given)
+        return [], None
+
+    def _summary(self, name, items, count):
+        items = ', '.join(self._repr.repr(item)
+                          for item in itertools.islice(items, self.max_items))
+        return '%s (%d): %s%s' % (name, count, items, ', ...' if count > self.max_items else '')
+
+    def _compare_strings(self, expected, given):
+        lines = []
+        if len(expected) != len(given):
+            lines.append('expected length %d, given %d' % (len(expected), len(given)))
+        index = self._first_difference(expected, given)
+        if index < min(len(expected), len(given)):
+            start = max(index - 20, 0)
+            lines.append('first difference at index %d: expected %s, given %s' % (
+                index, self._repr.repr(expected[start:index + 40]),
+                self._repr.repr(given[start:index + 40])))
+        return lines
+
+    def _compare_arrays(self, expected, given):
+        if expected.shape != given.shape:
+            return ['expected shape %s, given %s' % (expected.shape, given.shape)]
+        different = expected != given
+        if not expected.ndim or not different.any():
+            return []
+        index = tuple(int(indices[0]) for indices in different.nonzero())
+        return ['%d of %d elements differ, first at %s: expected %s, given %s' % (
+            different.sum(), different.size, index, self.format(expected[index]),
+            self.format(given[index]))]
+
+    def _compare_mappings(self, expected, given):
+        missing = [key for key in expected if key not in given]
+        unexpected = [key for key in given if key not in expected]
+        different = [key for key in expected if key in given and
+                     not _equals(expected[key], given[key])]
+        lines = []
+        if missing:
+            lines.append(self._summary('missing keys', missing, len(missing)))
+        if unexpected:
+            lines.append(self._summary('unexpected keys', unexpected, len(unexpected)))
+        if different:
+            lines.append(self._summary('different values of keys', different, len(different)))
+        return lines, different[0] if different else None
+
+    def _compare_sets(self, expected, given):
+        missing = expected - given
+        unexpected = given - expected
+        lines = []
+        if missing:
+            lines.append(self._summary('missing items', missing, len(missing)))
+        if unexpected:
+            lines.append(self._summary('unexpected items', unexpected, len(unexpected)))
+        return lines
+
+    def _compare_sequences(self, expected, given):
+        lines = []
+        if len(expected) != len(given):
+            lines.append('expected length %d, given %d' % (len(expected), len(given)))
+        index = self._first_difference(expected, given)
+        if index < min(len(expected), len(given)):
+            lines.append('first difference at index %d' % index)
+            return lines, index
+        if len(expected) > len(given):
+            lines.append(self._summary('missing items from index %d' % index,
+                                       itertools.islice(expected, index, None),
+                                       len(expected) - index))
+        elif len(given) > len(expected):
+            lines.append(self._summary('unexpected items from index %d' % index,
+                                       itertools.islice(given, index, None),
+                                       len(given) - index))
+        return lines, None
+
+    def _first_difference(self, expected, given):
+        """Return index of the first differing item, or length of the
+        shorter sequence if one is a prefix of the other
+        """
+        length = min(len(expected), len(given))
+        start = 0
+        if type(expected) is type(given) and isinstance(expected, (list, tuple, str, bytes)):
+            # skip equal chunks, comparing them at once
+            while start < length and expected[start:start + self.chunk_size] == \
+                    given[start:start + self.chunk_size]:
+                start += self.chunk_size
+        for index in range(start, length):
+            if not _equals(expected[index], given[index]):
+                return index
+        return length
 
 
 class expect:
@@ -462,8 +3227,8 @@ class expect:
 
     def __eq__(self, expectation):
         """expect(a) == b"""
-        assert self._context == expectation, \
-            "expected %s, given %s" % (expectation, self._context)
+        if not _equals(self._context, expectation):
+            raise AssertionError(Difference(expectation, self._context))
 
     def __ne__(self, expectation):
         """expect(a) != b"""
@@ -506,6 +3271,41 @@ class expect:
         assert self._context not in expectation, \
             "%s in %s" % (self._context, expectation)
 
+    def to_complete_within(self, seconds, repeat=5):
+        """expect(callable).to_complete_within(seconds): median time of a
+        call, measured in repeat rounds calibrated like benchmarks, is at
+        most given seconds
+        """
+        stats = Benchmark().run(self._context, rounds=repeat)
+        assert stats['median'] <= seconds, \
+            "expected to complete within %s, median %s (min %s, max %s, stddev %s, " \
+            "%d rounds of %d calls)" % (
+                format_time(seconds), format_time(stats['median']),
+                format_time(stats['min']), format_time(stats['max']),
+                format_time(stats['stddev']), stats['rounds'], stats['loops'])
+
+    def to_allocate_at_most(self, size):
+        """expect(callable).to_allocate_at_most(size): peak of memory
+        allocated during a call (after a warm-up call), traced by
+        tracemalloc, is at most size bytes
+        """
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        try:
+            self._context()
+            gc.collect()
+            start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            self._context()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+        assert peak - start <= size, \
+            "expected to allocate at most %s, allocated %s at peak, %s retained" % (
+                format_size(size), format_size(peak - start), format_size(current - start))
+
     def to_have_been_called(self, count=None):
         if isinstance(count, int):
             assert self._context.call_count == count, \
@@ -527,15 +3327,179 @@ class Script:
         parser.add_argument('--watch', action='store_true')
         parser.add_argument('--fast', action='store_true')
         parser.add_argument('--junit', action='store_true')
+        parser.add_argument('--junit-output', default=Runner.junit_output, metavar='PATH',
+                            help='path of JUnit XML file')
+        parser.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+                            help='run tests in N processes')
+        parser.add_argument('--durations', type=int, default=0, metavar='N',
+                            help='report N slowest tests')
+        parser.add_argument('--slow-threshold', type=float, default=Runner.slow_threshold,
+                            metavar='SECONDS',
+                            help='suggest @slow for tests running longer')
+        parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                            help='fail tests running longer (without @timeout)')
+        parser.add_argument('--concurrency', type=int, default=10, metavar='N',
+                            help='run at most N @concurrent async tests at once')
+        parser.add_argument('--profile', type=int, nargs='?', const=20, default=0, metavar='N',
+                            help='profile tests, report N hotspots and runner overhead')
+        parser.add_argument('--memcheck', type=float, nargs='?', const=64, default=0,
+                            metavar='KIB', help='report tests retaining more memory')
+        parser.add_argument('--coverage', action='store_true',
+                            help='record lines executed by each test')
+        parser.add_argument('--coverage-report', metavar='PATH',
+                            help='write LCOV report of recorded coverage')
+        parser.add_argument('--affected-by', metavar='DIFF',
+                            help="run only tests which executed lines changed by "
+                                 "unified diff ('-' for stdin)")
+        parser.add_argument('--rerun-failures', type=int, default=0, metavar='N',
+                            help='run failed tests again up to N times, report flaky ones')
+        parser.add_argument('--quarantine', metavar='PATH',
+                            help='file of quarantined tests ids or patterns, '
+                                 'their failures do not fail the run')
+        parser.add_argument('--incremental', action='store_true',
+                            help='skip behaviors which passed and whose spec files and '
+                                 'imported modules did not change')
+        parser.add_argument('--fork-server', action='store_true',
+                            help='run tests in workers forked from the runner process')
+        parser.add_argument('--preload', action='append', default=[], metavar='MODULE',
+                            help='import module before forking workers')
+        parser.add_argument('--preload-specs', action='store_true',
+                            help='import spec modules before forking workers')
+        parser.add_argument('--recycle-after', type=int, default=0, metavar='N',
+                            help='replace forked worker after it ran N tests')
+        parser.add_argument('--shard', type=self.parse_shard, metavar='I/N',
+                            help='run I-th of N shards of behaviors (e.g. CI nodes)')
+        parser.add_argument('--shard-timings', metavar='PATH',
+                            help='balance shards by timings file (like .flowp/timings)')
+        parser.add_argument('--merge-junit', nargs='+', metavar='PATH',
+                            help='merge JUnit XML files (given after the output path) '
+                                 'and exit')
+        parser.add_argument('--bench', action='store_true',
+                            help='run bench_ methods instead of tests')
+        parser.add_argument('--bench-compare', metavar='PATH',
+                            help='run bench_ methods and fail ones regressed comparing '
+                                 'to baseline file')
+        parser.add_argument('--bench-tolerance', type=float, default=10, metavar='PERCENT',
+                            help='allowed regression of benchmarks median')
+        parser.add_argument('--last-failed', action='store_true',
+                            help='run only tests which failed last time')
+        parser.add_argument('--failed-first', action='store_true',
+                            help='run tests which failed last time first')
+        parser.add_argument('--tmpdir-root', metavar='PATH',
+                            help='create temporary directories of tests in given '
+                                 'directory, like /dev/shm')
+        parser.add_argument('--collect-only', action='store_true',
+                            help='only list tests, parsing spec modules instead of importing '
+                                 'them where possible')
+        parser.add_argument('--ignore', action='append', default=[], metavar='PATTERN',
+                            help='do not search for specs in matching directories')
+        parser.add_argument('--changed-since', metavar='REF',
+                            help='run only specs depending on files changed '
+                                 'since given git reference')
         self.args = parser.parse_args()
+        self.changes = queue.Queue()
+
+    @staticmethod
+    def parse_shard(value):
+        """Parse I/N shard argument"""
+        try:
+            index, count = (int(number) for number in value.split('/'))
+        except ValueError:
+            raise argparse.ArgumentTypeError('expected I/N, e.g. 1/4')
+        if not 1 <= index <= count:
+            raise argparse.ArgumentTypeError('shard index should be from 1 to %s' % count)
+        return index, count
+
+    @staticmethod
+    def read_quarantine(path):
+        """Read ids or glob patterns of quarantined tests, one per line,
+        skipping empty lines and # comments
+        """
+        with open(path) as f:
+            lines = (line.partition('#')[0].strip() for line in f)
+            return tuple(line for line in lines if line)
 
     def watch_callback(self, filename, action):
-        args = [sys.executable, '-m', 'flowp.testing']
-        if self.args.fast:
-            args.append('--fast')
-        subprocess.call(args)
+        self.changes.put(filename)
+
+    def respawn(self):
+        """Replace the current process with a new one, which runs tests
+        with the changed runner and keeps watching
+        """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execv(sys.executable, [sys.executable, '-m', 'flowp.testing'] + sys.argv[1:])
+
+    def watch(self, runner):
+        """Keep the runner warm and rerun tests affected by
+        changed files in the current process.
+        """
+        # files of the runner can be placed deeper or outside of the project
+        watch = files.Watch(['*.py', '**/*.py', os.path.abspath(__file__)],
+                            self.watch_callback)
+        try:
+            while True:
+                filenames = {self.changes.get()}
+                # gather other changes reported in the same watch loop
+                time.sleep(0.01)
+                while not self.changes.empty():
+                    filenames.add(self.changes.get_nowait())
+                if not runner.rerun(filenames, fast_mode=self.args.fast,
+                                    junit=self.args.junit):
+                    watch.stop()
+                    self.respawn()
+        except KeyboardInterrupt:
+            watch.stop()
 
     def run(self):
-        Runner().run(fast_mode=self.args.fast, junit=self.args.junit)
+        if self.args.merge_junit:
+            output, *paths = self.args.merge_junit
+            JunitResults.merge_files(paths, output)
+            return None
+        runner = Runner()
+        runner.durations = self.args.durations
+        runner.slow_threshold = self.args.slow_threshold
+        runner.timeout = self.args.timeout
+        runner.concurrency = self.args.concurrency
+        runner.profile = self.args.profile
+        runner.memcheck = int(self.args.memcheck * 1024)
+        runner.incremental = self.args.incremental
+        runner.rerun_failures = self.args.rerun_failures
+        if self.args.quarantine:
+            runner.quarantine = self.read_quarantine(self.args.quarantine)
+        runner.coverage = self.args.coverage
+        runner.coverage_report = self.args.coverage_report
+        runner.affected_by = self.args.affected_by
+        runner.fork_server = self.args.fork_server
+        runner.preload = tuple(self.args.preload)
+        runner.preload_specs = self.args.preload_specs
+        runner.recycle_after = self.args.recycle_after
+        if self.args.bench or self.args.bench_compare:
+            baseline = None
+            if self.args.bench_compare:
+                with open(self.args.bench_compare) as f:
+                    baseline = json.load(f)
+            runner.benchmark = Benchmark(baseline, self.args.bench_tolerance / 100)
+            runner.test_method_prefix = runner.bench_method_prefix
+        runner.last_failed = self.args.last_failed
+        runner.failed_first = self.args.failed_first
+        runner.ignore_patterns += tuple(self.args.ignore)
+        runner.junit_output = self.args.junit_output
+        if self.args.shard:
+            runner.shard = self.args.shard
+            runner.shard_timings = self.args.shard_timings
+            # JUnit file per shard
+            root, ext = os.path.splitext(runner.junit_output)
+            runner.junit_output = '%s-%s-of-%s%s' % (root, self.args.shard[0],
+                                                    self.args.shard[1], ext)
+        TemporaryDirectory.pool.root = self.args.tmpdir_root
+        changed_files = None
+        if self.args.changed_since:
+            changed_files = runner.get_git_changed_files(self.args.changed_since)
+        if self.args.collect_only:
+            runner.collect(changed_files)
+            return None
+        runner.run(fast_mode=self.args.fast, junit=self.args.junit,
+                   jobs=self.args.jobs, changed_files=changed_files)
         if self.args.watch:
-            files.Watch(['*.py', '**/*.py'], self.watch_callback).wait()
+            self.watch(runner)
@@ -80,10 +80,6 @@ setup(
     author='Pawel Galazka',
     author_email='pawel.galazka@pracli.com',
     packages=['flowp', 'flowp.testing'],
-    install_requires=[
-        'glob2>=0.4.1,<0.4.99',
-        'junit-xml>=1.3',
-    ],
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Console',
@@ -91,6 +87,9 @@ setup(
         'License :: OSI Approved :: BSD License',
         'Operating System :: OS Independent',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
+        'Programming Language :: Python :: 3.13',
         'Topic :: Software Development',
         'Topic :: Software Development :: Testing'
     ]
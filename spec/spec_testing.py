@@ -1,8 +1,19 @@
 from flowp.testing import Behavior, expect, only, skip
-from flowp import testing
+from flowp import testing, files
 from unittest import mock
 import flowp.testing.dummy
 import tempfile
+import multiprocessing
+import pickle
+import weakref
+import time
+import tracemalloc
+import json
+import collections
+import asyncio
+from xml.etree import ElementTree
+import sys
+import io
 import os
 
 expect_alias = expect
@@ -57,6 +68,67 @@ class Expect(Behavior):
             with expect.to_raise(AssertionError):
                 expect(a).not_to_be(a)
 
+    class EqualOperator(Behavior):
+        def it_raises_assertion_error_with_lazy_difference(self):
+            try:
+                expect([1, 2]) == [1, 3]
+            except AssertionError as exc:
+                expect(exc.args[0]).to_be_instance_of(testing.Difference)
+                expect(str(exc).splitlines()[0]) == 'expected [1, 3], given [1, 2]'
+            else:
+                raise AssertionError('expected AssertionError')
+
+        def it_compares_values_compared_elementwise(self):
+            class Array(list):
+                shape = property(len)
+
+                def __eq__(self, other):
+                    return Array(a == b for a, b in zip(self, other))
+
+                def __bool__(self):
+                    raise ValueError('truth value is ambiguous')
+
+                def all(self):
+                    return all(self)
+
+            expect(Array([1, 2])) == Array([1, 2])
+            with expect.to_raise(AssertionError):
+                expect(Array([1, 2])) == Array([1, 3])
+
+    class ToCompleteWithinMethod(Behavior):
+        def it_passes_if_median_time_is_within_limit(self):
+            expect(lambda: None).to_complete_within(0.01)
+
+        def it_reports_distribution_of_times(self):
+            try:
+                expect(lambda: time.sleep(0.002)).to_complete_within(0.001, repeat=3)
+            except AssertionError as exc:
+                expect('expected to complete within 1.00 ms, median').to_be_in(str(exc))
+                expect('3 rounds of').to_be_in(str(exc))
+            else:
+                raise AssertionError('expected AssertionError')
+
+    class ToAllocateAtMostMethod(Behavior):
+        def it_passes_if_peak_allocation_is_within_limit(self):
+            # tracing can be started by the runner, with --memcheck
+            tracing = tracemalloc.is_tracing()
+            expect(lambda: [0] * 10).to_allocate_at_most(1024)
+            expect(tracemalloc.is_tracing()) == tracing
+
+        def it_reports_peak_and_retained_memory(self):
+            retained = []
+            with expect.to_raise(AssertionError):
+                expect(lambda: retained.append(bytearray(10 ** 5))).to_allocate_at_most(1024)
+            try:
+                expect(lambda: bytearray(10 ** 5)).to_allocate_at_most(1024)
+            except AssertionError as exc:
+                # tracing (like recording coverage) can allocate more during the call
+                peak = str(exc).partition('allocated ')[2].partition(' KiB at peak, ')
+                expect(float(peak[0]) >= 97.6).to_be(True)
+                expect(peak[2].endswith(' retained')).to_be(True)
+            else:
+                raise AssertionError('expected AssertionError')
+
     class ToRaiseMethod(Behavior):
         def before_each(self):
             class CustomException(Exception):
@@ -173,6 +245,49 @@ class Expect(Behavior):
                 expect(self.m).to_have_been_called(1)
 
 
+class Difference(Behavior):
+    def it_describes_first_difference_of_nested_containers(self):
+        difference = testing.Difference({'a': [1, 2, 3], 'b': 1}, {'a': [1, 2, 4], 'b': 1})
+        expect(str(difference).splitlines()) == [
+            "expected {'a': [1, 2, 3], 'b': 1}, given {'a': [1, 2, 4], 'b': 1}",
+            "  different values of keys (1): 'a'",
+            "at ['a']: expected [1, 2, 3], given [1, 2, 4]",
+            "  first difference at index 2",
+            "at ['a'][2]: expected 3, given 4"]
+
+    def it_summarizes_length_mismatch_and_missing_keys(self):
+        expect(str(testing.Difference(list(range(100)), list(range(90))))) == (
+            'expected [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, ...], given [0, 1, 2, 3, 4, 5, 6, 7, '
+            '8, 9, ...]\n  expected length 100, given 90\n'
+            '  missing items from index 90 (10): 90, 91, 92, 93, 94, ...')
+        expect('missing keys (1): 2').to_be_in(str(testing.Difference({1: 1, 2: 2}, {1: 1})))
+
+    def it_describes_sequences_which_can_not_be_sliced(self):
+        lines = str(testing.Difference(collections.deque([1, 2, 3]),
+                                       collections.deque([1]))).splitlines()
+        expect(lines[1:]) == ['  expected length 3, given 1',
+                              '  missing items from index 1 (2): 2, 3']
+
+    def it_shows_only_values_if_they_can_not_be_described(self):
+        with mock.patch.object(testing.Difference, 'describe', side_effect=TypeError()):
+            expect(str(testing.Difference([1], [2]))) == 'expected [1], given [2]'
+
+    def it_summarizes_set_differences(self):
+        lines = str(testing.Difference({1, 2, 3}, {3, 4})).splitlines()
+        expect(lines[1:]) == ['  missing items (2): 1, 2', '  unexpected items (1): 4']
+
+    def it_bounds_size_of_large_values(self):
+        difference = testing.Difference('a' * 10 ** 6 + 'b', 'a' * 10 ** 6 + 'c')
+        expect(len(str(difference))) < 400
+        expect('first difference at index 1000000').to_be_in(str(difference))
+
+    def it_releases_values_after_formatting(self):
+        difference = testing.Difference([1], [2])
+        str(difference)
+        expect(difference.expected).to_be(None)
+        expect(difference.given).to_be(None)
+
+
 class BehaviorInstance(Behavior):
     class MockMethod(Behavior):
         class WhenTargetNotGiven(Behavior):
@@ -245,10 +360,15 @@ class BehaviorInstance(Behavior):
                 def it_raise_exception(self):
                     raise AssertionError()
 
+                def it_hangs(self):
+                    time.sleep(5)
+
             self.expect = expect
             self.results = self.mock()
             self.results.executed = 1
             self.results.all = 2
+            self.results.profiler = self.results.memory_checker = None
+            self.results.benchmark = self.results.line_coverage = None
             self.pbehavior1 = self.mock(spec=['before_each', 'after_each'])
             self.pbehavior2 = self.mock(spec=['before_each', 'after_each'])
             self.behavior = TestBehavior('it_is_test', self.results)
@@ -334,6 +454,29 @@ class BehaviorInstance(Behavior):
                     expect(self.results.add_skipped).to_have_been_called(1)
 
 
+        class WhenTimeout(Behavior):
+            def before_each(self):
+                self.behavior.method_name = 'it_hangs'
+
+            def it_should_fail_test_exceeding_time_limit(self):
+                self.behavior.run(timeout=0.05)
+                exc_info = self.results.add_failure.call_args[0][0]
+                expect(exc_info[0]) == testing.TestTimeout
+
+            def it_should_take_time_limit_from_decorator(self):
+                testing.timeout(0.05)(self.behavior)
+                self.behavior.run()
+                expect(self.results.add_failure).to_have_been_called(1)
+
+            def it_should_prefer_time_limit_of_method(self):
+                testing.timeout(2)(self.behavior)
+                testing.timeout(1)(self.behavior.__class__.it_hangs)
+                expect(self.behavior.get_timeout(5)) == 1
+
+            def it_should_use_default_time_limit_without_decorator(self):
+                expect(self.behavior.get_timeout(5)) == 5
+
+
 class TemporaryDirectory(Behavior):
     def before_each(self):
         self.subject = testing.TemporaryDirectory()
@@ -345,3 +488,1218 @@ class TemporaryDirectory(Behavior):
         expect(os.path.samefile(os.getcwd(), self.subject.name)).to_be(True)
         self.subject.exit()
         expect(os.path.samefile(os.getcwd(), org_dir)).to_be(True)
+
+
+class TemporaryDirectoryPool(Behavior):
+    def before_each(self):
+        self.root = tempfile.mkdtemp()
+        self.subject = testing.TemporaryDirectoryPool(self.root)
+
+    def after_each(self):
+        self.subject.close()
+        os.rmdir(self.root)
+
+    def it_creates_directories_in_given_root(self):
+        path = self.subject.acquire()
+        expect(os.path.dirname(path)) == self.root
+
+    def it_reuses_cleared_directories(self):
+        path = self.subject.acquire()
+        os.mkdir(os.path.join(path, 'dir'))
+        files.touch(os.path.join(path, 'dir', 'file'))
+        self.subject.release(path)
+        self.subject.wait()
+        expect(self.subject.acquire()) == path
+        expect(os.listdir(path)) == []
+
+    def it_removes_directories_on_close(self):
+        path = self.subject.acquire()
+        self.subject.close()
+        expect(os.path.exists(path)).to_be(False)
+
+    def it_removes_directories_of_worker_processes_when_they_exit(self):
+        context = multiprocessing.get_context('fork')
+        paths = context.SimpleQueue()
+        # worker processes exit with os._exit, skipping atexit handlers
+        process = context.Process(target=lambda: paths.put(self.subject.acquire()))
+        process.start()
+        process.join()
+        expect(os.path.exists(paths.get())).to_be(False)
+
+
+class Results(Behavior):
+    def before_each(self):
+        self.subject = testing.Results(stream=io.StringIO())
+
+        class TestBehavior(Behavior):
+            def it_is_test(self):
+                pass
+
+        self.behavior = TestBehavior('it_is_test', self.subject)
+
+    def it_keeps_picklable_informations_about_failures(self):
+        try:
+            raise AssertionError()
+        except AssertionError:
+            self.subject.add_failure(sys.exc_info(), self.behavior)
+        summary = pickle.loads(pickle.dumps(self.subject.get_summary()))
+        err, info = summary['failures'][0]
+        expect(info.method_name) == 'it_is_test'
+        expect(info.description) == 'Test behavior'
+        expect(info.id) == 'spec.spec_testing:TestBehavior.it_is_test'
+
+    def it_formats_failures_when_they_are_printed(self):
+        try:
+            expect(1) == 2
+        except AssertionError:
+            self.subject.add_failure(sys.exc_info(), self.behavior)
+        err, info = self.subject.failures[0]
+        expect(err._text) == None
+        expect('expect(1) == 2').to_be_in(str(err))
+        expect('AssertionError').to_be_in(str(err))
+
+    def it_describes_differences_of_failures_when_they_are_printed(self):
+        with mock.patch.object(testing.Difference, 'describe',
+                               return_value=['expected 2, given 1']) as describe:
+            try:
+                expect(1) == 2
+            except AssertionError:
+                self.subject.add_failure(sys.exc_info(), self.behavior)
+            err, info = self.subject.failures[0]
+            expect(describe.called).to_be(False)
+            expect('AssertionError: expected 2, given 1').to_be_in(str(err))
+            expect(describe.call_count) == 1
+
+    def it_releases_locals_of_failed_test_frames(self):
+        class Local:
+            pass
+
+        def failing():
+            local = Local()
+            self.ref = weakref.ref(local)
+            raise AssertionError()
+
+        try:
+            failing()
+        except AssertionError:
+            self.subject.add_failure(sys.exc_info(), self.behavior)
+        expect(self.ref()) == None
+
+    def it_merges_summaries(self):
+        other = testing.Results(stream=io.StringIO())
+        other.add_executed()
+        other.add_skipped(self.behavior)
+        try:
+            raise AssertionError()
+        except AssertionError:
+            other.add_failure(sys.exc_info(), self.behavior)
+        self.subject.add_executed()
+        self.subject.merge(other.get_summary())
+        expect(self.subject.executed) == 2
+        expect(self.subject.skipped) == 1
+        expect(len(self.subject.failures)) == 1
+
+    class PrintProgressMethod(Behavior):
+        def before_each(self):
+            self.stream = io.StringIO()
+            self.subject = testing.Results(stream=self.stream)
+            self.subject.all = 10
+            self.subject.executed = 1
+
+        def it_prints_lines_periodically_if_output_is_not_a_terminal(self):
+            self.subject.progress_interval = 0
+            self.subject.print_progress()
+            self.subject.print_progress()
+            expect(self.stream.getvalue().count('Executed 1 of 10 ')) == 2
+            expect('\r').not_to_be_in(self.stream.getvalue())
+
+        def it_does_not_print_more_often_than_interval(self):
+            self.subject.print_progress()
+            expect(self.stream.getvalue()) == ''
+
+        def it_redraws_line_in_place_on_terminal(self):
+            self.mock(self.stream, 'isatty', new=lambda: True)
+            self.subject._progress_time = 0
+            self.subject.print_progress()
+            self.subject.print_progress()
+            expect(self.stream.getvalue().count('\rExecuted 1 of 10 ')) == 1
+
+        def it_does_not_print_if_all_tests_executed(self):
+            self.subject.progress_interval = 0
+            self.subject.executed = 10
+            self.subject.print_progress()
+            expect(self.stream.getvalue()) == ''
+
+
+class JunitResults(Behavior):
+    def before_each(self):
+        self.tmpdir.enter()
+        self.subject = testing.JunitResults(stream=io.StringIO(), path='junit.xml')
+
+        class TestBehavior(Behavior):
+            def it_prints(self):
+                print('<output>')
+
+        self.behavior = TestBehavior('it_prints', self.subject)
+        self.subject.all = 1
+
+    def after_each(self):
+        self.tmpdir.exit()
+
+    def it_writes_test_cases_as_soon_as_tests_end(self):
+        self.behavior.run()
+        with open('junit.xml') as f:
+            content = f.read()
+        expect('classname="spec.spec_testing.TestBehavior" name="it_prints"').to_be_in(content)
+        expect('<system-out>&lt;output&gt;\n</system-out>').to_be_in(content)
+
+    def it_writes_totals_at_the_end(self):
+        self.behavior.run()
+        self.subject.print(0.5)
+        root = ElementTree.parse('junit.xml').getroot()
+        expect(root[0].get('tests')) == '1'
+        expect(root[0].get('failures')) == '0'
+        expect(float(root[0][0].get('time')) > 0).to_be(True)
+
+    def it_counts_written_failures_also_put_aside_later(self):
+        try:
+            raise AssertionError()
+        except AssertionError:
+            self.subject.add_failure(sys.exc_info(), self.behavior)
+        # failure of flaky test, moved by the runner after a rerun
+        self.subject.flaky.append(self.subject.failures.pop())
+        self.subject.print(0.5)
+        root = ElementTree.parse('junit.xml').getroot()
+        expect(root[0].get('failures')) == '1'
+        expect(len(root[0].findall('testcase/failure'))) == 1
+
+    def it_creates_directory_of_the_file(self):
+        testing.JunitResults(stream=io.StringIO(), path='reports/specs.xml').print(0.5)
+        expect(os.path.isfile(os.path.join('reports', 'specs.xml'))).to_be(True)
+
+    def it_merges_files_summing_totals(self):
+        self.behavior.run()
+        self.subject.print(0.5)
+        testing.JunitResults.merge_files(['junit.xml', 'junit.xml'], 'merged.xml')
+        root = ElementTree.parse('merged.xml').getroot()
+        expect(root[0].get('tests')) == '2'
+        expect(root[0].get('time')) == '1.000'
+        expect(len(root[0].findall('testcase'))) == 2
+
+
+class Runner(Behavior):
+    class RunShardFunction(Behavior):
+        def before_each(self):
+            self.tmpdir.enter()
+
+            class TestBehavior(Behavior):
+                def it_passes(self):
+                    pass
+
+                def it_fails(self):
+                    raise AssertionError()
+
+                class Nested(Behavior):
+                    def it_passes(self):
+                        pass
+
+            mock.patch.object(sys.modules[__name__], 'TestBehavior', TestBehavior,
+                              create=True).start()
+            self.args = {'runner_cls': testing.Runner, 'module_name': __name__,
+                         'class_name': 'TestBehavior', 'dumps_dir': self.tmpdir.name}
+
+        def after_each(self):
+            for path in list(testing._dump_files):
+                if path.startswith(self.tmpdir.name):
+                    testing._dump_files.pop(path).close()
+            self.tmpdir.exit()
+
+        def it_runs_tests_of_behavior_class_and_returns_summary(self):
+            summary = testing._run_shard(self.args)
+            expect(summary['executed']) == 3
+            expect(len(summary['failures'])) == 1
+
+        def it_does_not_run_timed_out_tests(self):
+            timed_out = frozenset([__name__ + ':TestBehavior.it_fails'])
+            summary = testing._run_shard(dict(self.args, timed_out=timed_out))
+            expect(summary['executed']) == 2
+            expect(len(summary['failures'])) == 0
+
+        def it_returns_profile_of_tests_when_profiling(self):
+            summary = testing._run_shard(dict(self.args, settings={'profile': 5}))
+            expect(sorted(summary['profile']['stats'])) == [
+                __name__ + ':TestBehavior', __name__ + ':TestBehavior.Nested']
+            expect('imports').to_be_in(summary['profile']['phases'])
+
+        def it_sends_summary_of_each_test_to_sink(self):
+            sink = mock.Mock()
+            summary = testing._run_shard(self.args, sink)
+            messages = [call[0][0] for call in sink.send.call_args_list]
+            expect(sorted(message[1] for message in messages)) == [
+                __name__ + ':TestBehavior.Nested.it_passes',
+                __name__ + ':TestBehavior.it_fails', __name__ + ':TestBehavior.it_passes']
+            expect(sum(message[2]['executed'] for message in messages)) == 3
+            expect(summary['executed']) == 0
+            expect(summary['loaded']) == 3
+
+    class RunForkedMethod(Behavior):
+        def before_each(self):
+            self.tmpdir.enter()
+
+            class TestBehavior(Behavior):
+                def it_passes(self):
+                    pass
+
+                def it_stops(self):
+                    os._exit(3)
+
+                def it_fails(self):
+                    raise AssertionError()
+
+            mock.patch.object(sys.modules[__name__], 'TestBehavior', TestBehavior,
+                              create=True).start()
+            self.runner = testing.Runner()
+            self.results = testing.Results(stream=io.StringIO())
+            self.results.show_progress = False
+            self.results.all = 3
+
+        def after_each(self):
+            self.tmpdir.exit()
+
+        def it_streams_results_and_fails_behavior_when_worker_exits(self):
+            shards = [(__name__, 'TestBehavior', None, 3)]
+            self.runner._run_forked(shards, 2, False, False, self.results,
+                                    self.tmpdir.name, set())
+            expect(self.results.executed) == 3
+            expect(self.results.all) == 3
+            expect([info.method_name for exc, info in self.results.failures]) == [
+                'it_fails', 'worker']
+            expect('exited with code 3').to_be_in(str(self.results.failures[1][0]))
+
+        def it_recycles_workers_after_given_number_of_tests(self):
+            self.runner.recycle_after = 1
+            shards = [(__name__, 'TestBehavior', [__name__ + ':TestBehavior.it_passes'], 1)
+                      for i in range(3)]
+            self.results.all = 3
+            self.runner._run_forked(shards, 1, False, False, self.results,
+                                    self.tmpdir.name, set())
+            expect(self.results.executed) == 3
+            expect(self.results.failures) == []
+
+    class ReadDumpsMethod(Behavior):
+        def before_each(self):
+            self.tmpdir.enter()
+            with open('1', 'w') as f:
+                f.write('spec_a:A.it_passes\n')
+            with open('2', 'w') as f:
+                f.write('spec_a:A.it_hangs\nThread 0x01 (most recent call first):\n')
+
+        def after_each(self):
+            self.tmpdir.exit()
+
+        def it_returns_dumps_of_tests_which_did_not_respond_to_timeout(self):
+            dumps = testing.Runner()._read_dumps(self.tmpdir.name)
+            expect(dumps) == {'spec_a:A.it_hangs': 'Thread 0x01 (most recent call first):\n'}
+            expect(os.listdir(self.tmpdir.name)) == []
+
+    class LoadTestsMethod(Behavior):
+        def before_each(self):
+            class Shared(Behavior):
+                def it_records_parents(self):
+                    pass
+
+            class First(Behavior):
+                Nested = Shared
+
+            class Second(Behavior):
+                Nested = Shared
+
+            self.First, self.Second, self.Shared = First, Second, Shared
+            self.subject = testing.Runner()
+            self.subject.loaded_tests = []
+            self.results = testing.Results(stream=io.StringIO())
+
+        def it_plans_tests_without_creating_behaviors(self):
+            self.subject.load_tests(self.First, self.results)
+            test, = self.subject.loaded_tests
+            expect(test).to_be_instance_of(testing.PlannedTest)
+            expect(test.id) == __name__ + ':First.Shared.it_records_parents'
+            with expect.to_raise(AttributeError):
+                test.method_name = 'it_other'
+
+        def it_does_not_write_parents_on_nested_classes(self):
+            self.subject.load_tests(self.First, self.results)
+            self.subject.load_tests(self.Second, self.results)
+            expect([test.parent_behaviors for test in self.subject.loaded_tests]) == [
+                (self.First,), (self.Second,)]
+            expect(self.Shared.parent_behaviors) == ()
+            expect(self.subject.loaded_tests[1].create(self.results).get_info().id) == \
+                __name__ + ':Second.Shared.it_records_parents'
+
+    class RunTestsMethod(Behavior):
+        def before_each(self):
+            calls = self.calls = []
+
+            class TestBehavior(Behavior):
+                def before_all(self):
+                    calls.append('before_all')
+                    self.shared = []
+
+                def after_all(self):
+                    calls.append('after_all')
+
+                def it_fails(self):
+                    self.shared.append('it_fails')
+                    raise AssertionError()
+
+                def it_passes(self):
+                    self.shared.append('it_passes')
+
+                class Nested(Behavior):
+                    def before_all(self):
+                        calls.append('nested before_all')
+
+                    def it_passes(self):
+                        self.shared.append('nested it_passes')
+                        calls.extend(self.shared)
+
+            self.TestBehavior = TestBehavior
+            self.subject = testing.Runner()
+            self.results = testing.Results(stream=io.StringIO())
+
+        def it_calls_before_all_and_after_all_once_per_behavior(self):
+            self.subject.load_tests(self.TestBehavior, self.results)
+            self.subject.run_tests(self.subject.loaded_tests, self.results)
+            expect(self.calls) == ['before_all', 'nested before_all', 'nested it_passes',
+                                   'after_all']
+            expect(self.results.executed) == 3
+            expect(len(self.results.failures)) == 1
+
+        def it_fails_tests_if_before_all_fails(self):
+            def before_all(self):
+                raise RuntimeError()
+            self.TestBehavior.before_all = before_all
+            self.subject.load_tests(self.TestBehavior, self.results)
+            self.subject.run_tests(self.subject.loaded_tests, self.results)
+            expect(len(self.results.failures)) == 3
+            expect(self.calls) == []
+
+        def it_fails_all_concurrent_tests_if_before_all_fails(self):
+            @testing.concurrent
+            class ConcurrentBehavior(Behavior):
+                def before_all(self):
+                    raise RuntimeError()
+
+                async def it_a(self):
+                    pass
+
+                it_b = it_c = it_a
+
+            self.subject.load_tests(ConcurrentBehavior, self.results)
+            self.subject.run_tests(self.subject.loaded_tests, self.results)
+            expect(self.results.executed) == 3
+            expect(sorted(info.method_name for err, info in self.results.failures)) == \
+                ['it_a', 'it_b', 'it_c']
+
+        def it_creates_behaviors_just_before_their_tests(self):
+            instances = []
+
+            class TestBehavior(Behavior):
+                def it_a(self):
+                    instances.append(weakref.ref(self))
+                    expect([instance() for instance in instances[:-1]]) == \
+                        [None] * (len(instances) - 1)
+
+                it_b = it_c = it_a
+
+            self.subject.load_tests(TestBehavior, self.results)
+            self.subject.run_tests(self.subject.loaded_tests, self.results)
+            expect(len(instances)) == 3
+            expect(self.results.failures) == []
+
+        def it_runs_async_tests_and_hooks_on_shared_event_loop(self):
+            loops = self.calls
+
+            class AsyncBehavior(Behavior):
+                async def before_all(self):
+                    loops.append(asyncio.get_running_loop())
+
+                async def before_each(self):
+                    loops.append(asyncio.get_running_loop())
+
+                async def it_runs(self):
+                    loops.append(asyncio.get_running_loop())
+
+            self.subject.load_tests(AsyncBehavior, self.results)
+            self.subject.run_tests(self.subject.loaded_tests, self.results)
+            expect(self.results.failures) == []
+            expect(len(loops)) == 3
+            expect(len(set(loops))) == 1
+
+        def it_runs_concurrent_tests_at_once_up_to_concurrency(self):
+            running = []
+
+            @testing.concurrent
+            class ConcurrentBehavior(Behavior):
+                async def it_a(self):
+                    running.append(1)
+                    await asyncio.sleep(0.01)
+                    self.calls.append(sum(running))
+                    running.pop()
+
+                it_b = it_c = it_d = it_a
+
+            ConcurrentBehavior.calls = self.calls
+            self.subject.concurrency = 3
+            self.subject.load_tests(ConcurrentBehavior, self.results)
+            self.subject.run_tests(self.subject.loaded_tests, self.results)
+            expect(self.results.executed) == 4
+            expect(self.results.failures) == []
+            expect(max(self.calls)) == 3
+
+        def it_fails_concurrent_test_exceeding_time_limit(self):
+            @testing.concurrent
+            class ConcurrentBehavior(Behavior):
+                async def it_hangs(self):
+                    await asyncio.sleep(5)
+
+                async def it_passes(self):
+                    pass
+
+            self.subject.timeout = 0.05
+            self.subject.load_tests(ConcurrentBehavior, self.results)
+            self.subject.run_tests(self.subject.loaded_tests, self.results)
+            expect([info.method_name for exc, info in self.results.failures]) == ['it_hangs']
+            expect('TestTimeout').to_be_in(str(self.results.failures[0][0]))
+
+    class GetModuleNameMethod(Behavior):
+        def it_converts_file_paths_to_module_names(self):
+            runner = testing.Runner()
+            expect(runner.get_module_name(os.path.join('spec', 'spec_a.py'))) == 'spec.spec_a'
+            expect(runner.get_module_name(os.path.join('pkg', '__init__.py'))) == 'pkg'
+
+    class WhenProjectChanged(Behavior):
+        def before_each(self):
+            self.tmpdir.enter()
+            sys.path.insert(0, self.tmpdir.name)
+            with open('rerun_base.py', 'w') as f:
+                f.write('value = 0\n')
+            with open('rerun_lib.py', 'w') as f:
+                f.write('from rerun_base import value\n')
+            with open('rerun_other.py', 'w') as f:
+                f.write('value = 2\n')
+            with open('spec_rerun_lib.py', 'w') as f:
+                f.write('import rerun_lib\n')
+            with open('spec_rerun_other.py', 'w') as f:
+                f.write('from rerun_other import value\n')
+            import spec_rerun_lib, spec_rerun_other
+            self.subject = testing.Runner()
+            self.run_modules = self.mock(self.subject, 'run_modules')
+
+        def after_each(self):
+            sys.path.remove(self.tmpdir.name)
+            for name in ('rerun_base', 'rerun_lib', 'rerun_other',
+                         'spec_rerun_lib', 'spec_rerun_other'):
+                sys.modules.pop(name, None)
+            self.tmpdir.exit()
+
+        class RunMethod(Behavior):
+            def it_loads_only_specs_depending_on_changed_files(self):
+                self.subject.run(changed_files=['rerun_base.py'])
+                modules = self.run_modules.call_args[0][0]
+                expect([m.__name__ for m in modules]) == ['spec_rerun_lib']
+
+            def it_does_not_parse_imports_without_changed_files(self):
+                with mock.patch.object(self.subject, 'get_importers_graph') as graph:
+                    self.subject.run()
+                expect(graph.called).to_be(False)
+
+        class RerunMethod(Behavior):
+            def it_runs_only_spec_modules_importing_changed_module(self):
+                expect(self.subject.rerun(['rerun_lib.py'])).to_be(True)
+                modules = self.run_modules.call_args[0][0]
+                expect([m.__name__ for m in modules]) == ['spec_rerun_lib']
+
+            def it_reloads_changed_modules(self):
+                with open('rerun_other.py', 'w') as f:
+                    f.write('value = 30\n')
+                self.subject.rerun(['rerun_other.py'])
+                expect(sys.modules['spec_rerun_other'].value) == 30
+
+            def it_refuses_to_reload_the_runner_itself(self):
+                root = os.path.dirname(os.path.dirname(flowp.__file__))
+                with files.cd(root):
+                    expect(self.subject.rerun([testing.__file__])).to_be(False)
+
+            def it_refuses_to_reload_the_runner_placed_outside_of_the_project(self):
+                expect(self.subject.rerun([testing.__file__])).to_be(False)
+
+    class GetSpecFilesMethod(Behavior):
+        def before_each(self):
+            self.tmpdir.enter()
+            for path in ('spec', os.path.join('spec', 'unit'), 'node_modules', '.git'):
+                os.mkdir(path)
+            for path in (os.path.join('spec', 'spec_a.py'),
+                         os.path.join('spec', 'unit', 'spec_b.py'),
+                         os.path.join('spec', 'helpers.py'),
+                         os.path.join('node_modules', 'spec_c.py'),
+                         os.path.join('.git', 'spec_d.py')):
+                files.touch(path)
+            self.subject = testing.Runner()
+
+        def after_each(self):
+            self.tmpdir.exit()
+
+        def it_finds_spec_files_in_not_ignored_directories(self):
+            expect(self.subject.get_spec_files()) == [
+                os.path.join('spec', 'spec_a.py'),
+                os.path.join('spec', 'unit', 'spec_b.py')]
+
+        def it_scans_only_directories_modified_since_previous_run(self):
+            # the first run creates storage directory
+            self.subject.get_spec_files()
+            self.subject.get_spec_files()
+            files.touch(os.path.join('spec', 'unit', 'spec_e.py'))
+            with mock.patch.object(self.subject, '_scan_directory',
+                                   wraps=self.subject._scan_directory) as scan:
+                spec_files = self.subject.get_spec_files()
+            expect(scan).to_have_been_called(1)
+            expect(os.path.join('spec', 'unit', 'spec_e.py')).to_be_in(spec_files)
+
+    class CollectSourceMethod(Behavior):
+        def before_each(self):
+            self.source = (
+                'from flowp.testing import Behavior, only, skip, slow\n'
+                'from flowp import testing\n'
+                '\n'
+                'class Helper:\n'
+                '    def it_is_not_a_test(self):\n'
+                '        pass\n'
+                '\n'
+                '@skip\n'
+                'class A(Behavior):\n'
+                '    def it_a(self):\n'
+                '        pass\n'
+                '\n'
+                '    class Nested(testing.Behavior):\n'
+                '        @slow\n'
+                '        def it_b(self):\n'
+                '            pass\n'
+                '\n'
+                'class B(A):\n'
+                '    @only\n'
+                '    def it_c(self):\n'
+                '        pass\n'
+            )
+            self.subject = testing.Runner()
+
+        def it_finds_markers_with_arguments(self):
+            tests = self.subject.collect_source(
+                'class A(Behavior):\n'
+                '    @testing.timeout(5)\n'
+                '    def it_a(self):\n'
+                '        pass\n')
+            expect(tests) == [[['A'], 'it_a', ['timeout']]]
+
+        def it_finds_behaviors_tests_and_markers(self):
+            tests = self.subject.collect_source(self.source)
+            expect(tests) == [
+                [['A', 'Nested'], 'it_b', ['skip', 'slow']],
+                [['A'], 'it_a', ['skip']],
+                [['B', 'Nested'], 'it_b', ['slow']],
+                [['B'], 'it_a', []],
+                [['B'], 'it_c', ['only']],
+            ]
+
+        def it_finds_tests_inherited_through_classes_of_the_module(self):
+            tests = self.subject.collect_source(
+                'class Mixin:\n'
+                '    def it_a(self):\n'
+                '        pass\n'
+                '\n'
+                'class A(Behavior, Mixin):\n'
+                '    pass\n'
+                '\n'
+                'class B(A):\n'
+                '    pass\n')
+            expect(tests) == [[['A'], 'it_a', []], [['B'], 'it_a', []]]
+
+        def it_returns_none_if_bases_of_classes_are_unknown(self):
+            expect(self.subject.collect_source(
+                'from flowp.testing import Behavior as B\n'
+                'class A(B):\n'
+                '    pass\n')).to_be(None)
+            expect(self.subject.collect_source(
+                'from spec.helpers import Base\n'
+                'class A(Behavior):\n'
+                '    class Nested(Base):\n'
+                '        pass\n')).to_be(None)
+
+    class WhenBehaviorsAreImported(Behavior):
+        def before_each(self):
+            self.tmpdir.enter()
+            sys.path.insert(0, self.tmpdir.name)
+            with open('collect_base.py', 'w') as f:
+                f.write('from flowp.testing import Behavior\n'
+                        'class Base(Behavior):\n'
+                        '    def it_base(self):\n'
+                        '        pass\n')
+            with open('spec_collect.py', 'w') as f:
+                f.write('from flowp.testing import Behavior as B\n'
+                        'from collect_base import Base\n'
+                        'class A(B):\n'
+                        '    def it_a(self):\n'
+                        '        pass\n'
+                        'class D(Base):\n'
+                        '    def it_d(self):\n'
+                        '        pass\n')
+            self.expected = ['collect_base:Base.it_base', 'spec_collect:A.it_a',
+                             'spec_collect:D.it_base', 'spec_collect:D.it_d']
+
+        def after_each(self):
+            sys.path.remove(self.tmpdir.name)
+            for name in ('collect_base', 'spec_collect'):
+                sys.modules.pop(name, None)
+            self.tmpdir.exit()
+
+        def run_once(self, jobs=1, shard=None):
+            runner = testing.Runner()
+            runner.shard = shard
+            # not stopped by tests run by the runner
+            with mock.patch.object(runner, 'finish') as finish:
+                runner.run(jobs=jobs)
+            return sorted(finish.call_args[0][0].durations)
+
+        def it_collects_tests_by_importing_spec_module(self):
+            tests = testing.Runner().collect_tests(['spec_collect.py'])
+            expect(sorted(test.id for test in tests)) == self.expected
+
+        def it_runs_them_in_parallel_mode(self):
+            expect(self.run_once()) == self.expected
+            expect(self.run_once(jobs=2)) == self.expected
+
+        def it_runs_each_of_them_in_one_shard(self):
+            ids = []
+            for index in range(1, 4):
+                ids.extend(self.run_once(shard=(index, 3)))
+            expect(sorted(ids)) == self.expected
+
+    class RunParallelMethod(Behavior):
+        def before_each(self):
+            self.tmpdir.enter()
+            sys.path.insert(0, self.tmpdir.name)
+            with open('spec_parallel.py', 'w') as f:
+                f.write('from flowp.testing import Behavior\n'
+                        'class A(Behavior):\n'
+                        '    def it_a(self):\n'
+                        '        pass\n'
+                        '\n'
+                        '    def it_b(self):\n'
+                        '        pass\n')
+            self.subject = testing.Runner()
+
+        def after_each(self):
+            sys.path.remove(self.tmpdir.name)
+            sys.modules.pop('spec_parallel', None)
+            self.tmpdir.exit()
+
+        def it_runs_only_affected_tests(self):
+            self.subject.affected_tests = ({'spec_parallel:A.it_a'},
+                                           {'spec_parallel:A.it_a', 'spec_parallel:A.it_b'})
+            with mock.patch.object(self.subject, 'finish') as finish:
+                self.subject.run_parallel(['spec_parallel.py'], 2)
+            expect(list(finish.call_args[0][0].durations)) == ['spec_parallel:A.it_a']
+
+    class GetShardsMethod(Behavior):
+        def before_each(self):
+            self.tests = [testing.CollectedTest('spec_a', ('A',), 'it_a', []),
+                          testing.CollectedTest('spec_a', ('A', 'Nested'), 'it_b', []),
+                          testing.CollectedTest('spec_a', ('B',), 'it_c', [])]
+            self.subject = testing.Runner()
+
+        def it_splits_tests_by_top_level_behaviors_the_longest_first(self):
+            timings = {'spec_a:B.it_c': [10, 10], 'spec_a:A.it_a': [1, 1]}
+            shards = self.subject.get_shards(self.tests, timings, set())
+            expect(shards) == [('spec_a', 'B', None, 1), ('spec_a', 'A', None, 2)]
+
+        def it_puts_behaviors_with_failed_tests_first_in_failed_first_mode(self):
+            self.subject.failed_first = True
+            shards = self.subject.get_shards(self.tests, {'spec_a:B.it_c': [3, 3]},
+                                             {'spec_a:A.Nested.it_b'})
+            expect(shards[0][:2]) == ('spec_a', 'A')
+
+        def it_gives_ids_of_tests_selected_by_affected_tests(self):
+            self.subject.affected_tests = ({'spec_a:A.it_a'}, {'spec_a:A.it_a'})
+            shards = self.subject.get_shards(self.tests[:1], {}, set())
+            expect(shards) == [('spec_a', 'A', {'spec_a:A.it_a'}, 1)]
+
+    class GetShardClassesMethod(Behavior):
+        def before_each(self):
+            self.tmpdir.enter()
+            tests = [testing.CollectedTest('spec_a', ('A',), 'it_a', []),
+                     testing.CollectedTest('spec_a', ('A',), 'it_b', []),
+                     testing.CollectedTest('spec_a', ('B',), 'it_c', []),
+                     testing.CollectedTest('spec_b', ('C',), 'it_d', [])]
+            self.subject = testing.Runner()
+            self.subject.collect_tests = lambda spec_files: tests
+
+        def after_each(self):
+            self.tmpdir.exit()
+
+        def get_shards(self, count):
+            shards = []
+            for index in range(1, count + 1):
+                self.subject.shard = (index, count)
+                shards.append(self.subject.get_shard_classes([]))
+            return shards
+
+        def it_balances_shards_by_number_of_tests_without_timings(self):
+            expect(self.get_shards(2)) == [{('spec_a', 'A')}, {('spec_a', 'B'), ('spec_b', 'C')}]
+
+        def it_balances_shards_by_timings_if_given(self):
+            with open('timings', 'w') as f:
+                json.dump({'spec_a:B.it_c': [10, 10], 'spec_a:A.it_a': [1, 1]}, f)
+            self.subject.shard_timings = 'timings'
+            # tests without timings get the average one
+            expect(self.get_shards(2)) == [{('spec_a', 'B')}, {('spec_a', 'A'), ('spec_b', 'C')}]
+
+        def it_assigns_every_behavior_to_exactly_one_shard(self):
+            shards = self.get_shards(3)
+            expect(sum(len(shard) for shard in shards)) == 3
+            expect(set().union(*shards)) == {('spec_a', 'A'), ('spec_a', 'B'), ('spec_b', 'C')}
+
+    class HandleFailuresMethod(Behavior):
+        def before_each(self):
+            self.tmpdir.enter()
+            runs = self.runs = []
+
+            class TestBehavior(Behavior):
+                def it_is_flaky(self):
+                    runs.append('it_is_flaky')
+                    assert runs.count('it_is_flaky') > 1
+
+                def it_fails(self):
+                    runs.append('it_fails')
+                    assert False
+
+                def it_is_quarantined(self):
+                    assert False
+
+            self.subject = testing.Runner()
+            self.subject.rerun_failures = 2
+            self.subject.quarantine = ('*.it_is_q*',)
+            self.results = testing.Results(stream=io.StringIO())
+            self.results.show_progress = False
+            self.subject.load_tests(TestBehavior, self.results)
+            self.subject.run_tests(self.subject.loaded_tests, self.results)
+
+        def after_each(self):
+            self.tmpdir.exit()
+
+        def it_reruns_failed_tests_and_moves_aside_flaky_ones(self):
+            self.subject.handle_failures(self.results)
+            expect([info.method_name for err, info in self.results.failures]) == ['it_fails']
+            expect([info.method_name for err, info in self.results.flaky]) == ['it_is_flaky']
+            expect(self.runs.count('it_fails')) == 3
+
+        def it_does_not_rerun_quarantined_tests(self):
+            self.subject.handle_failures(self.results)
+            expect([info.method_name for err, info in self.results.quarantined]) == [
+                'it_is_quarantined']
+            expect('(1 flaky) (1 quarantined)').to_be_in(self.results.get_execution_info())
+
+        def it_stores_history_of_flaky_and_failing_tests(self):
+            self.subject.handle_failures(self.results)
+            history = self.subject.storage.load('flaky')
+            expect(history[__name__ + ':TestBehavior.it_is_flaky']['flaky']) == 1
+            expect(history[__name__ + ':TestBehavior.it_fails']['failed']) == 1
+
+    class FinishMethod(Behavior):
+        def before_each(self):
+            self.tmpdir.enter()
+            self.subject = testing.Runner()
+            self.results = testing.Results(stream=io.StringIO())
+            self.results.durations = {'spec_a:A.it_a': (1.0, 1.0)}
+            for method_name in ('it_a', 'after_all'):
+                try:
+                    raise AssertionError()
+                except AssertionError:
+                    self.results.add_failure(sys.exc_info(),
+                                             testing.TestInfo('spec_a', ('A',), method_name))
+
+        def after_each(self):
+            self.tmpdir.exit()
+
+        def it_stores_timings_and_failures_of_tests(self):
+            self.subject.finish(self.results, time.time(), set())
+            expect(list(self.subject.storage.load('timings'))) == ['spec_a:A.it_a']
+            # after_all method is not a test, which could be run again
+            expect(self.subject.storage.load('failures')) == ['spec_a:A.it_a']
+
+        def it_does_not_store_them_for_benchmarks(self):
+            self.subject.benchmark = testing.Benchmark()
+            self.subject.finish(self.results, time.time(), set())
+            expect(self.subject.storage.load('timings')).to_be(None)
+            expect(self.subject.storage.load('failures')).to_be(None)
+
+    class SelectCachedMethod(Behavior):
+        def before_each(self):
+            self.tmpdir.enter()
+            with open('spec_a.py', 'w') as f:
+                f.write('import helper\n')
+            with open('helper.py', 'w') as f:
+                f.write('VALUE = 1\n')
+            self.tests = [testing.CollectedTest('spec_a', ('A',), 'it_a', []),
+                          testing.CollectedTest('spec_a', ('A', 'Nested'), 'it_b', []),
+                          testing.CollectedTest('spec_a', ('B',), 'it_c', [])]
+
+        def after_each(self):
+            self.tmpdir.exit()
+
+        def run_once(self, fast_mode=False, failing=()):
+            runner = testing.Runner()
+            results = testing.Results(stream=io.StringIO())
+            selected = runner.select_cached(self.tests, results, fast_mode)
+            for test in selected:
+                results.durations[test.id] = (0.1, 0.1)
+                if test.method_name in failing:
+                    results.add_failure((AssertionError, AssertionError(), None), test)
+            runner.save_incremental(results)
+            return [test.method_name for test in selected], results.cached
+
+        def it_reports_tests_of_passed_behaviors_as_cached(self):
+            expect(self.run_once(failing=['it_c'])) == (['it_a', 'it_b', 'it_c'], 0)
+            expect(self.run_once()) == (['it_c'], 2)
+            expect(self.run_once()) == ([], 3)
+
+        def it_runs_behaviors_again_when_imported_modules_change(self):
+            self.run_once()
+            with open('helper.py', 'w') as f:
+                f.write('VALUE = 2\n')
+            expect(self.run_once()) == (['it_a', 'it_b', 'it_c'], 0)
+
+        def it_drops_cache_when_configuration_changes(self):
+            self.run_once()
+            expect(self.run_once(fast_mode=True)) == (['it_a', 'it_b', 'it_c'], 0)
+
+    class SelectTestsMethod(Behavior):
+        def before_each(self):
+            class TestBehavior(Behavior):
+                def it_a(self):
+                    pass
+
+                def it_b(self):
+                    pass
+
+            self.subject = testing.Runner()
+            self.subject.load_tests(TestBehavior, testing.Results(stream=io.StringIO()))
+            self.failed = {self.subject.loaded_tests[1].get_info().id}
+
+        def it_keeps_only_failed_tests_in_last_failed_mode(self):
+            self.subject.last_failed = True
+            tests = self.subject.select_tests(self.subject.loaded_tests, self.failed)
+            expect([b.method_name for b in tests]) == ['it_b']
+
+        def it_keeps_all_tests_in_last_failed_mode_if_no_failed_test_is_planned(self):
+            self.subject.last_failed = True
+            tests = self.subject.select_tests(self.subject.loaded_tests,
+                                              {'spec_other:A.it_a'})
+            expect([b.method_name for b in tests]) == ['it_a', 'it_b']
+
+        def it_forgets_failed_tests_missing_in_their_modules(self):
+            module = self.subject.loaded_tests[0].module
+            self.failed.update([module + ':TestBehavior.after_all', 'spec_other:A.it_a'])
+            self.subject.select_tests(self.subject.loaded_tests, self.failed)
+            expect(sorted(self.failed)) == [module + ':TestBehavior.it_b', 'spec_other:A.it_a']
+
+        def it_moves_failed_tests_to_the_beginning_in_failed_first_mode(self):
+            self.subject.failed_first = True
+            tests = self.subject.select_tests(self.subject.loaded_tests, self.failed)
+            expect([b.method_name for b in tests]) == ['it_b', 'it_a']
+
+        def it_keeps_affected_tests_and_tests_missing_in_coverage_index(self):
+            a_id, b_id = [test.id for test in self.subject.loaded_tests]
+            self.subject.affected_tests = (set(), {a_id})
+            tests = self.subject.select_tests(self.subject.loaded_tests, set())
+            expect([b.method_name for b in tests]) == ['it_b']
+            self.subject.affected_tests = ({a_id}, {a_id, b_id})
+            tests = self.subject.select_tests(self.subject.loaded_tests, set())
+            expect([b.method_name for b in tests]) == ['it_a']
+
+    class PrintDurationsMethod(Behavior):
+        def before_each(self):
+            class TestBehavior(Behavior):
+                def it_is_fast(self):
+                    pass
+
+                def it_is_slow(self):
+                    pass
+
+                @testing.slow
+                def it_is_marked_as_slow(self):
+                    pass
+
+            self.subject = testing.Runner()
+            self.results = testing.Results(stream=io.StringIO())
+            self.subject.load_tests(TestBehavior, self.results)
+            for test in self.subject.loaded_tests:
+                behavior = test.create(self.results)
+                wall_time = 0.1 if behavior.method_name == 'it_is_fast' else 2.0
+                self.results.add_duration(behavior, wall_time, wall_time)
+
+        def it_suggests_marking_slow_tests(self):
+            self.subject.print_durations(self.results)
+            output = self.results.stream._stream.getvalue()
+            expect('Test behavior is slow' in output).to_be(True)
+            expect('Test behavior is fast' in output).to_be(False)
+            expect('is marked as slow' in output).to_be(False)
+
+        def it_reports_the_slowest_tests(self):
+            self.subject.durations = 1
+            self.subject.print_durations(self.results)
+            output = self.results.stream._stream.getvalue()
+            expect(output.count('Test behavior is marked as slow')) == 1
+
+
+class Profiler(Behavior):
+    def before_each(self):
+        self.subject = testing.Profiler()
+
+        class TestBehavior(Behavior):
+            def it_sleeps(self):
+                time.sleep(0.01)
+
+        self.behavior = TestBehavior('it_sleeps', testing.Results(stream=io.StringIO()))
+
+    def it_aggregates_stats_per_behavior_class(self):
+        for i in range(2):
+            self.subject.enable(self.behavior)
+            self.behavior.it_sleeps()
+            self.subject.disable()
+        expect(list(self.subject.profiles)) == [__name__ + ':TestBehavior']
+        (path, seconds), = self.subject.get_behaviors_times()
+        expect(seconds >= 0.02) == True
+
+    def it_merges_summaries_of_other_processes(self):
+        other = testing.Profiler()
+        other.enable(self.behavior)
+        self.behavior.it_sleeps()
+        other.disable()
+        with other.phase('imports'):
+            pass
+        self.subject.enable(self.behavior)
+        self.behavior.it_sleeps()
+        self.subject.disable()
+        self.subject.merge(pickle.loads(pickle.dumps(other.get_summary())))
+        stats = self.subject.get_stats()
+        sleep = next(stat for func, stat in stats.stats.items() if 'sleep' in func[2])
+        expect(sleep[1]) == 2
+        expect('imports').to_be_in(self.subject.phases)
+
+
+class MemoryChecker(Behavior):
+    def before_each(self):
+        self.subject = testing.MemoryChecker(64 * 1024)
+        self.retained = []
+        retained = self.retained
+
+        class TestBehavior(Behavior):
+            def it_retains(self):
+                retained.append([str(i) for i in range(10000)])
+
+            def it_sets_attribute(self):
+                self.data = [str(i) for i in range(10000)]
+
+        self.TestBehavior = TestBehavior
+        self.tracing = tracemalloc.is_tracing()
+
+    def after_each(self):
+        if not self.tracing:
+            tracemalloc.stop()
+
+    def it_reports_tests_retaining_memory(self):
+        behavior = self.TestBehavior('it_retains', testing.Results(stream=io.StringIO()))
+        self.subject.start(behavior)
+        behavior.it_retains()
+        self.subject.stop(behavior)
+        (test_id, retained, sites), = self.subject.leaks
+        expect(test_id) == __name__ + ':TestBehavior.it_retains'
+        expect(retained > 64 * 1024) == True
+        expect(__file__).to_be_in(sites[0])
+
+    def it_does_not_report_attributes_set_on_behavior_instance(self):
+        behavior = self.TestBehavior('it_sets_attribute', testing.Results(stream=io.StringIO()))
+        self.subject.start(behavior)
+        behavior.it_sets_attribute()
+        self.subject.stop(behavior)
+        expect(self.subject.leaks) == []
+        expect(hasattr(behavior, 'data')) == False
+
+    def it_does_not_report_event_loop_of_the_first_async_test(self):
+        class AsyncBehavior(Behavior):
+            async def it_awaits(self):
+                await asyncio.sleep(0)
+
+        # creating event loop allocates about 6 KiB
+        self.subject.threshold = 4096
+        results = testing.Results(stream=io.StringIO())
+        results.memory_checker = self.subject
+        AsyncBehavior('it_awaits', results).run()
+        results.close_loop()
+        expect(self.subject.leaks) == []
+
+
+class LineCoverage(Behavior):
+    def before_each(self):
+        self.subject = testing.LineCoverage()
+
+        class TestBehavior(Behavior):
+            def it_executes_lines(self):
+                value = 1
+                return value
+
+        self.behavior = TestBehavior('it_executes_lines', testing.Results(stream=io.StringIO()))
+        self.index = testing.LineCoverage.update_index({}, {
+            'spec_a:A.it_a': {'a.py': [1, 2]}, 'spec_a:A.it_b': {'a.py': [2, 3]}})
+
+    def it_records_project_lines_executed_by_test(self):
+        self.subject.start(self.behavior)
+        self.behavior.it_executes_lines()
+        self.subject.stop(self.behavior)
+        self.subject.close()
+        lines = self.subject.lines[__name__ + ':TestBehavior.it_executes_lines']
+        path = os.path.relpath(__file__)
+        expect(list(lines)) == [path]
+        expect(len(lines[path])) == 2
+
+    def it_uses_other_tool_id_if_coverage_one_is_in_use(self):
+        monitoring = getattr(sys, 'monitoring', None)
+        if monitoring is None:
+            # tracing is used before Python 3.12
+            return None
+        claimed = monitoring.get_tool(monitoring.COVERAGE_ID) is None
+        if claimed:
+            monitoring.use_tool_id(monitoring.COVERAGE_ID, 'other')
+        try:
+            self.it_records_project_lines_executed_by_test()
+        finally:
+            if claimed:
+                monitoring.free_tool_id(monitoring.COVERAGE_ID)
+
+    def it_falls_back_to_tracing_if_all_tool_ids_are_in_use(self):
+        self.subject._claim_tool_id = lambda: None
+        self.it_records_project_lines_executed_by_test()
+
+    def it_does_not_stop_test_if_recording_fails(self):
+        self.subject.start = mock.Mock(side_effect=ValueError('tool 1 is already in use'))
+        self.behavior._results.line_coverage = self.subject
+        self.behavior.run()
+        expect(self.behavior._results.executed) == 1
+        expect(len(self.behavior._results.failures)) == 1
+
+    def it_finds_tests_which_executed_changed_lines(self):
+        expect(testing.LineCoverage.get_tests(self.index, {'a.py': {2}})) == {
+            'spec_a:A.it_a', 'spec_a:A.it_b'}
+        expect(testing.LineCoverage.get_tests(self.index, {'a.py': {3, 4}})) == {
+            'spec_a:A.it_b'}
+
+    def it_replaces_lines_of_tests_run_again(self):
+        index = testing.LineCoverage.update_index(self.index, {'spec_a:A.it_a': {'a.py': [4]}})
+        expect(index['tests']) == ['spec_a:A.it_b', 'spec_a:A.it_a']
+        expect(index['files']) == {'a.py': {'2': [0], '3': [0], '4': [1]}}
+
+    def it_parses_changed_lines_of_old_files_from_diff(self):
+        diff = (
+            'diff --git a/a.py b/a.py\n'
+            '--- a/a.py\n'
+            '+++ b/a.py\n'
+            '@@ -2,3 +2,3 @@\n'
+            ' x = 1\n'
+            '-y = 2\n'
+            '+y = 3\n'
+            ' z = 3\n'
+            '@@ -10,0 +11,1 @@\n'
+            '+w = 4\n'
+            '--- /dev/null\n'
+            '+++ b/b.py\n'
+            '@@ -0,0 +1 @@\n'
+            '+v = 5\n')
+        expect(testing.LineCoverage.parse_diff(diff)) == {'a.py': {3, 10, 11}}
+
+    def it_writes_lcov_report(self):
+        self.tmpdir.enter()
+        with open('a.py', 'w') as f:
+            f.write('a = 1\nb = 2\n\ndef f():\n    return 3\n')
+        testing.LineCoverage.write_lcov(self.index, 'coverage.info')
+        with open('coverage.info') as f:
+            report = f.read().splitlines()
+        self.tmpdir.exit()
+        expect(report[2:]) == ['DA:1,1', 'DA:2,2', 'DA:3,1', 'DA:4,0', 'DA:5,0',
+                               'LF:5', 'LH:3', 'end_of_record']
+
+
+class Script(Behavior):
+    class RespawnMethod(Behavior):
+        def it_replaces_process_with_one_running_changed_runner_and_watching(self):
+            execv = self.mock(os, 'execv')
+            self.mock(sys, 'argv', ['flowp.testing', '--watch', '-j', '2'])
+            testing.Script.__new__(testing.Script).respawn()
+            expect(execv).to_have_been_called_with(
+                sys.executable, [sys.executable, '-m', 'flowp.testing', '--watch', '-j', '2'])
+
+
+class Benchmark(Behavior):
+    def before_each(self):
+        self.subject = testing.Benchmark()
+        self.subject.warmup_time = 0
+        self.subject.round_time = 0.001
+        self.subject.max_time = 0.01
+        self.calls = 0
+
+    def call(self):
+        self.calls += 1
+
+    def it_calibrates_number_of_calls_per_round(self):
+        stats = self.subject.run(self.call)
+        expect(stats['loops'] > 1) == True
+        expect(stats['rounds'] >= self.subject.min_rounds) == True
+        expect(self.calls >= stats['loops'] * stats['rounds']) == True
+        expect(stats['min'] <= stats['median']) == True
+
+    def it_fails_benchmark_which_regressed_beyond_tolerance(self):
+        self.subject.baseline = {'spec:A.bench_a': {'median': 1.0}}
+        self.subject.check('spec:A.bench_a', {'median': 1.05})
+        with expect.to_raise(AssertionError):
+            self.subject.check('spec:A.bench_a', {'median': 1.2})
+
+    def it_passes_benchmarks_without_baseline(self):
+        self.subject.check('spec:A.bench_a', {'median': 1.2})
+
+    def it_is_run_instead_of_test_method(self):
+        results = testing.Results(stream=io.StringIO())
+        results.benchmark = self.subject
+        call = self.call
+
+        class TestBehavior(Behavior):
+            def bench_call(self):
+                call()
+
+        TestBehavior('bench_call', results).run()
+        expect(results.executed) == 1
+        expect(list(results.benchmarks)) == [__name__ + ':TestBehavior.bench_call']
+
+
+class Storage(Behavior):
+    def before_each(self):
+        self.tmpdir.enter()
+        self.subject = testing.Storage()
+
+    def after_each(self):
+        self.tmpdir.exit()
+
+    def it_saves_and_loads_data(self):
+        self.subject.save('timings', {'test': [1.5, 1.0]})
+        expect(self.subject.load('timings')) == {'test': [1.5, 1.0]}
+
+    def it_returns_default_if_nothing_saved(self):
+        expect(self.subject.load('timings', {})) == {}